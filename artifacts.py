@@ -0,0 +1,129 @@
+import datetime
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+import persist
+
+
+
+PDF_MAGIC = b"%PDF-"
+CHUNK_SIZE = 64 * 1024
+
+
+
+def has_magic(path, magic):
+    with open(path, "rb") as fp:
+        return fp.read(len(magic)) == magic
+
+
+
+def file_chunks(path):
+    with open(path, "rb") as fp:
+        while True:
+            chunk = fp.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+
+# Files are stored under their sha256 in objects/ and each period has an index
+# mapping the file names to their hash, size and time of storage.
+class ArtifactStore(object):
+    def __init__(self, root):
+        self._root = root
+        self._objdir = os.path.join(root, "objects")
+        self._idxdir = os.path.join(root, "index")
+
+    def _indexpath(self, period):
+        return os.path.join(self._idxdir, period + ".json")
+
+    def _objpath(self, digest):
+        return os.path.join(self._objdir, digest[:2], digest[2:])
+
+    def index(self, period):
+        return persist.read_json(self._indexpath(period), {})
+
+    def lookup(self, period, name):
+        entry = self.index(period).get(name)
+        if entry is None:
+            return None
+
+        try:
+            size = os.stat(self._objpath(entry["sha256"])).st_size
+        except FileNotFoundError:
+            logging.warning("Artifact %s of period %s is indexed but missing", name, period)
+            return None
+
+        if size != entry["size"]:
+            logging.warning("Artifact %s of period %s has size %d instead of %d", name, period, size, entry["size"])
+            return None
+
+        return entry
+
+    def add(self, period, name, chunks, magic=None, replace=True):
+        index = self.index(period)
+        if not replace and name in index:
+            raise FileExistsError("Artifact %s already exists for period %s" % (name, period))
+
+        os.makedirs(self._objdir, exist_ok=True)
+        h = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self._objdir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                for chunk in chunks:
+                    h.update(chunk)
+                    size += len(chunk)
+                    fp.write(chunk)
+
+            if magic is not None and not has_magic(tmp, magic):
+                raise ValueError("Artifact %s does not start with %r" % (name, magic))
+
+            digest = h.hexdigest()
+            objpath = self._objpath(digest)
+            os.makedirs(os.path.dirname(objpath), exist_ok=True)
+            os.replace(tmp, objpath)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+        logging.debug("Stored artifact %s of period %s as %s (%d bytes)", name, period, digest, size)
+        index[name] = {
+            "sha256": digest,
+            "size": size,
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+        persist.write_json(self._indexpath(period), index)
+        return index[name]
+
+    def add_file(self, period, name, path, magic=None, replace=True):
+        return self.add(period, name, file_chunks(path), magic, replace)
+
+    def path(self, period, name):
+        entry = self.lookup(period, name)
+        if entry is None:
+            raise FileNotFoundError("No artifact %s for period %s" % (name, period))
+        return self._objpath(entry["sha256"])
+
+    def read(self, period, name):
+        with open(self.path(period, name), "rb") as fp:
+            return fp.read()
+
+    def link(self, period, name, dest):
+        src = self.path(period, name)
+        dirname = os.path.dirname(dest) or "."
+        tmp = os.path.join(dirname, ".tmp-" + os.path.basename(dest))
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+
+        try:
+            os.link(src, tmp)
+        except OSError:
+            logging.debug("Can't hardlink %r, copying it instead", src)
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import urssaf
+
+
+
+# Synthetic frontend versions. They reproduce the shape of the real main.js
+# around the OAuth config (shorthand variables, base URL computed from
+# window.location, ternaries on config values, parseInt calls) at the sizes
+# seen so far, with the config object at different places in the file.
+VERSIONS = [
+    {"name": "v1-small", "size": 600 * 1024, "position": 0.3, "cfgvar": "c", "basevar": "Bs", "ternaries": 2, "extrakeys": 4},
+    {"name": "v2-medium", "size": 1200 * 1024, "position": 0.6, "cfgvar": "Ke", "basevar": "Zt", "ternaries": 4, "extrakeys": 12},
+    {"name": "v3-current", "size": 1700 * 1024, "position": 0.8, "cfgvar": "e", "basevar": "Rt", "ternaries": 6, "extrakeys": 20},
+    {"name": "v4-large", "size": 3 * 1024 * 1024, "position": 0.95, "cfgvar": "Wn", "basevar": "Fo", "ternaries": 12, "extrakeys": 40},
+]
+
+CONFIG = {
+    "ARCHIMED_LOGIN_API_URL": "https://login.example.invalid/api/",
+    "ARCHIMED_CLIENT_ID": "0123456789abcdef",
+    "ARCHIMED_SCOPE": "openid profile",
+    "API_URL": "https://api.example.invalid/",
+    "USE_CODE_FLOW": "1",
+    "SILENT_REFRESH": "",
+    "SESSION_TIMEOUT": "1800",
+}
+
+
+
+def noise(rng, size):
+    # Minified-looking code with balanced braces and without "oauth:"
+    parts = []
+    total = 0
+    n = 0
+    while total < size:
+        n += 1
+        name = "f%x" % n
+        kind = rng.randrange(4)
+        if kind == 0:
+            s = "function %s(t,n){return t+n*%d}" % (name, rng.randrange(1000))
+        elif kind == 1:
+            s = "var %s={id:%d,label:\"%s\",flags:[%s]};" % (name, n, name.upper(), ",".join(str(rng.randrange(9)) for _ in range(5)))
+        elif kind == 2:
+            s = "%s.prototype.ngOnInit=function(){this.value=%d?this.a:this.b};" % (name, rng.randrange(2))
+        else:
+            s = "const %s=(t)=>{if(t>%d){return\"%s\"}return null};" % (name, rng.randrange(100), "x" * rng.randrange(40))
+        parts.append(s)
+        total += len(s)
+
+    return "".join(parts)
+
+
+
+def make_fixture(version, servicesurl):
+    rng = random.Random(version["name"])
+    c = version["cfgvar"]
+    base = version["basevar"]
+
+    js = []
+    expected = {}
+
+    js.append("production:!0")
+    expected["production"] = True
+    js.append("apiUrl:%s+\"api/\"" % base)
+    expected["apiUrl"] = servicesurl + "api/"
+    for i in range(version["extrakeys"]):
+        js.append("feature%d:{enabled:%s,label:\"Feature %d\"}" % (i, "!0" if i % 2 else "!1", i))
+        expected["feature%d" % i] = {"enabled": bool(i % 2), "label": "Feature %d" % i}
+
+    oauth = []
+    oauthexp = {}
+    oauth.append("issuer:Ps")
+    oauthexp["issuer"] = CONFIG["ARCHIMED_LOGIN_API_URL"]
+    oauth.append("loginUrl:Ps+\"oauth/authorize\"")
+    oauthexp["loginUrl"] = CONFIG["ARCHIMED_LOGIN_API_URL"] + "oauth/authorize"
+    oauth.append("tokenEndpoint:Ps+\"oauth/token\"")
+    oauthexp["tokenEndpoint"] = CONFIG["ARCHIMED_LOGIN_API_URL"] + "oauth/token"
+    oauth.append("redirectUri:%s+\"index.html\"" % base)
+    oauthexp["redirectUri"] = servicesurl + "index.html"
+    oauth.append("clientId:%s.ARCHIMED_CLIENT_ID" % c)
+    oauthexp["clientId"] = CONFIG["ARCHIMED_CLIENT_ID"]
+    oauth.append("scope:%s.ARCHIMED_SCOPE" % c)
+    oauthexp["scope"] = CONFIG["ARCHIMED_SCOPE"]
+    oauth.append("sessionTimeout:parseInt(\"%s\",10)" % CONFIG["SESSION_TIMEOUT"])
+    oauthexp["sessionTimeout"] = int(CONFIG["SESSION_TIMEOUT"])
+
+    for i in range(version["ternaries"]):
+        flag = "USE_CODE_FLOW" if i % 2 == 0 else "SILENT_REFRESH"
+        key = "responseType" if i == 0 else "option%d" % i
+        oauth.append("%s:%s.%s?\"code\":\"token\"" % (key, c, flag))
+        oauthexp[key] = "code" if CONFIG[flag] else "token"
+
+    js.append("oauth:{%s}" % ",".join(oauth))
+    expected["oauth"] = oauthexp
+
+    decls = [
+        "%s=window.location.origin+\"/services/\"" % base,
+        "%s=Qt" % c,
+        "Ps=%s.ARCHIMED_LOGIN_API_URL" % c,
+    ]
+    cfg = "var %s,env={%s};" % (",".join(decls), ",".join(js))
+
+    size = version["size"] - len(cfg)
+    before = int(size * version["position"])
+    mainjs = noise(rng, before) + ";" + cfg + noise(rng, size - before)
+
+    configjs = "window.__env = {\n%s,\n}\n" % ",\n".join("    %s: %s" % (json.dumps(k), json.dumps(v)) for k, v in CONFIG.items())
+    return mainjs, configjs, expected
+
+
+
+def synthetic_corpus():
+    for version in VERSIONS:
+        mainjs, configjs, expected = make_fixture(version, urssaf.URSSAF.servicesurl)
+        yield version["name"], mainjs, configjs, expected
+
+
+
+def load_corpus(corpusdir):
+    for name in sorted(os.listdir(corpusdir)):
+        fixturedir = os.path.join(corpusdir, name)
+        if not os.path.isdir(fixturedir):
+            continue
+
+        with open(os.path.join(fixturedir, "main.js")) as fp:
+            mainjs = fp.read()
+        with open(os.path.join(fixturedir, "config.js")) as fp:
+            configjs = fp.read()
+
+        expected = None
+        expectedpath = os.path.join(fixturedir, "expected.json")
+        if os.path.exists(expectedpath):
+            with open(expectedpath) as fp:
+                expected = json.load(fp)
+
+        yield name, mainjs, configjs, expected
+
+
+
+def write_corpus(corpusdir):
+    for name, mainjs, configjs, expected in synthetic_corpus():
+        fixturedir = os.path.join(corpusdir, name)
+        os.makedirs(fixturedir, exist_ok=True)
+        with open(os.path.join(fixturedir, "main.js"), "w") as fp:
+            fp.write(mainjs)
+        with open(os.path.join(fixturedir, "config.js"), "w") as fp:
+            fp.write(configjs)
+        with open(os.path.join(fixturedir, "expected.json"), "w") as fp:
+            json.dump(expected, fp, indent=4)
+
+
+
+def timeit(func, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        res = func()
+        times.append(time.perf_counter() - start)
+
+    return res, min(times), statistics.median(times)
+
+
+
+def bench(name, mainjs, configjs, expected, runs):
+    servicesurl = urssaf.URSSAF.servicesurl
+    config = urssaf.parse_config_js(configjs)
+
+    def braces():
+        cfgidx = urssaf.enclosing_opening_brace(mainjs, mainjs.index("oauth:"))
+        return urssaf.matching_braces(mainjs[cfgidx:])
+
+    _, bmin, bmed = timeit(braces, runs)
+    res, tmin, tmed = timeit(lambda: urssaf.extract_main_config(mainjs, config, servicesurl), runs)
+
+    if expected is None:
+        status = "unchecked"
+    elif res == expected:
+        status = "ok"
+    else:
+        status = "MISMATCH"
+
+    print("%-16s %8.1fKiB %10.2fms %10.2fms %10.2fms %10.2fms  %s" %
+          (name, len(mainjs) / 1024, tmin * 1000, tmed * 1000, bmin * 1000, bmed * 1000, status))
+    return status != "MISMATCH"
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mesure le temps d'extraction de la configuration OAuth de main.js")
+    parser.add_argument("--corpus", "-c", metavar="dir", help="Répertoire de fixtures (un sous-répertoire par version contenant main.js, config.js et expected.json)")
+    parser.add_argument("--write-corpus", metavar="dir", help="Écrit le corpus synthétique dans le répertoire donné et quitte")
+    parser.add_argument("--runs", "-n", type=int, default=5, help="Nombre d'exécutions par fixture")
+    args = parser.parse_args()
+
+    if args.write_corpus:
+        write_corpus(args.write_corpus)
+        return
+
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus()
+
+    print("%-16s %11s %12s %12s %12s %12s" % ("fixture", "size", "extract min", "extract med", "braces min", "braces med"))
+    ok = True
+    for name, mainjs, configjs, expected in corpus:
+        ok &= bench(name, mainjs, configjs, expected, args.runs)
+
+    if not ok:
+        sys.exit(1)
+
+
+
+if __name__ == '__main__':
+    main()
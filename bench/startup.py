@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+
+def importtime(module):
+    cmd = [sys.executable, "-X", "importtime", "-c", "import " + module]
+    res = subprocess.run(cmd, cwd=ROOT, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, check=True)
+
+    times = []
+    for line in res.stderr.decode().splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        selftime, cumulative, name = line[len("import time:"):].split("|")
+        times.append((int(cumulative), int(selftime), name.rstrip()))
+
+    return times
+
+
+
+def walltime(code, runs):
+    cmd = [sys.executable, "-c", code]
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=ROOT, check=True)
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mesure le temps de démarrage des programmes")
+    parser.add_argument("modules", metavar="module", nargs="*", default=["declare", "checkpayments"], help="Modules à importer")
+    parser.add_argument("--runs", "-n", type=int, default=20, help="Nombre d'exécutions pour la mesure du temps total")
+    parser.add_argument("--top", "-t", type=int, default=10, help="Nombre d'imports les plus lents à afficher")
+    args = parser.parse_args()
+
+    baseline = walltime("pass", args.runs)
+    print("Interpreter startup: %.1fms" % (baseline * 1000))
+
+    for module in args.modules:
+        times = importtime(module)
+        total = next(c for c, _, name in times if name.strip() == module)
+        wall = walltime("import " + module, args.runs) - baseline
+        print()
+        print("%s: %.1fms import time, %.1fms wall time above interpreter startup" % (module, total / 1000, wall * 1000))
+
+        times.sort(reverse=True)
+        for cumulative, selftime, name in times[1:args.top + 1]:
+            print("  %8.1fms %8.1fms  %s" % (cumulative / 1000, selftime / 1000, name))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import concurrent.futures
+import decimal
+import glob
+import itertools
+import locale
+import logging
+import logging.config
+import os
+import sys
+
+import invoicefile
+import paymentfile
+
+
+
+SELFPATH = os.path.dirname(os.path.realpath(sys.argv[0]))
+INVOICE_CHUNK = 256
+PAYMENT_CHUNK = 4096
+
+
+
+def logging_getHandler(name):
+    for h in logging.getLogger().handlers:
+        if h.name == name:
+            return h
+    return None
+
+
+
+def chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+
+# The parsing functions run in worker processes and return the errors instead
+# of raising them so that every problem gets reported
+def parse_invoices(paths):
+    res = []
+    for path in paths:
+        try:
+            res.append((path, invoicefile.Invoice.fromfile(path), None))
+        except (OSError, ValueError) as e:
+            res.append((path, None, str(e)))
+        except decimal.InvalidOperation:
+            res.append((path, None, "Invalid invoice amount"))
+    return res
+
+
+
+def parse_payments(lines):
+    res = []
+    for lineno, line in lines:
+        try:
+            p = paymentfile.parse_line(line, lineno)
+        except ValueError as e:
+            res.append((lineno, None, str(e)))
+            continue
+        except decimal.InvalidOperation:
+            res.append((lineno, None, "Invalid payment amount in line %r" % line.rstrip("\n")))
+            continue
+
+        if p is not None:
+            res.append((lineno, p, None))
+    return res
+
+
+
+class Checker(object):
+    def __init__(self, invdir, payfile, jobs=None):
+        self._invdir = invdir
+        self._payfile = payfile
+        self._jobs = jobs
+        self.problems = []
+
+    def report(self, location, msg):
+        self.problems.append((location, msg))
+
+    def _read(self, executor):
+        invfutures = []
+        if self._invdir is not None and not os.path.isfile(self._invdir):
+            paths = sorted(glob.iglob(self._invdir + "/*.inv"))
+            invfutures = [executor.submit(parse_invoices, c) for c in chunks(paths, INVOICE_CHUNK)]
+
+        payfutures = []
+        if self._payfile is not None:
+            try:
+                with open(self._payfile) as fp:
+                    for c in chunks(enumerate(fp, 1), PAYMENT_CHUNK):
+                        payfutures.append(executor.submit(parse_payments, c))
+            except OSError as e:
+                self.report((self._payfile, 0), str(e))
+
+        invoices = []
+        if self._invdir is not None and os.path.isfile(self._invdir):
+            # A ledger is read in a single streaming pass while the workers
+            # parse the paymentfile
+            errors = []
+            try:
+                invoices.extend(invoicefile.iter_ledger(self._invdir, errors))
+            except (OSError, ValueError) as e:
+                self.report((self._invdir, 0), str(e))
+            for lineno, err in errors:
+                self.report((self._invdir, lineno), err)
+
+        for f in invfutures:
+            for path, inv, err in f.result():
+                if err is not None:
+                    self.report((path, 0), err)
+                else:
+                    invoices.append(inv)
+
+        payments = []
+        for f in payfutures:
+            for lineno, p, err in f.result():
+                if err is not None:
+                    self.report((self._payfile, lineno), err)
+                else:
+                    payments.append(p)
+
+        return invoices, payments
+
+    def check(self):
+        with concurrent.futures.ProcessPoolExecutor(self._jobs) as executor:
+            invoices, payments = self._read(executor)
+
+        invindex = {}
+        for inv in invoices:
+            other = invindex.get(inv.invnum)
+            if other is not None:
+                self.report((inv.source, 0), "Invoice number %s already used in %s" % (inv.invnum, other.source))
+                continue
+            invindex[inv.invnum] = inv
+
+        transindex = {}
+        paid = collections.defaultdict(list)
+        for p in payments:
+            loc = (self._payfile, p.lineno)
+            key = (p.date, p.amount, p.label)
+            if key in transindex:
+                self.report(loc, "Duplicate transaction, already at line %d" % transindex[key].lineno)
+            else:
+                transindex[key] = p
+
+            paid[p.invnum].append(p)
+            inv = invindex.get(p.invnum)
+            if inv is None:
+                if self._invdir is not None:
+                    self.report(loc, "No invoice %s" % p.invnum)
+                continue
+
+            if p.date < inv.invdate or p.date > inv.duedate + invoicefile.PAYMENT_DELAY:
+                self.report(loc, "Payment on %s outside of the payment window of invoice %s (%s to %s)" %
+                            (p.date, inv.invnum, inv.invdate, inv.duedate))
+
+        for invnum, plist in paid.items():
+            inv = invindex.get(invnum)
+            if inv is None:
+                continue
+
+            total = sum(p.amount for p in plist)
+            if total != inv.amount:
+                lines = ", ".join(str(p.lineno) for p in plist)
+                self.report((self._payfile, plist[0].lineno), "Invoice %s amounts to %s but payments at lines %s sum to %s" %
+                            (invnum, inv.amount, lines, total))
+
+        self.problems.sort()
+        return self.problems
+
+
+
+def main():
+    locale.setlocale(locale.LC_ALL, '')
+    logging.config.fileConfig(os.path.join(SELFPATH, "logconf.ini"), disable_existing_loggers=False)
+
+    parser = argparse.ArgumentParser(description="Vérifie la cohérence des factures et du paymentfile")
+    parser.add_argument("--invoice-dir", "-i", metavar="dir", help="Répertoire contenant les fichiers .inv ou registre des factures (.jsonl ou .csv)")
+    parser.add_argument("--payment", "-p", metavar="file", help="Fichier des factures payées")
+    parser.add_argument("--jobs", "-j", metavar="N", type=int, help="Nombre de processus à utiliser (par défaut le nombre de processeurs)")
+    parser.add_argument("--verbose", "-v", action="count", default=0, help="Augmente le niveau de verbosité")
+    parser.add_argument("--quiet", "-q", action="count", default=0, help="Diminue le niveau de verbosité")
+
+    args = parser.parse_args()
+
+    verbose = args.verbose - args.quiet
+    invdir = args.invoice_dir
+    payfile = args.payment
+    jobs = args.jobs
+
+    loglevels = ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"]
+    ch = logging_getHandler("consoleHandler")
+    curlevel = logging.getLevelName(ch.level)
+    curlevel = loglevels.index(curlevel)
+    verbose = min(len(loglevels) - 1, max(0, curlevel + verbose))
+    ch.setLevel(loglevels[verbose])
+
+    checker = Checker(invdir, payfile, jobs)
+    problems = checker.check()
+    for (path, lineno), msg in problems:
+        if lineno:
+            print("%s:%d: %s" % (path, lineno, msg))
+        else:
+            print("%s: %s" % (path, msg))
+
+    if problems:
+        sys.exit(1)
+
+
+
+if __name__ == '__main__':
+    main()
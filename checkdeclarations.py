@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import json
+import locale
+import logging
+import logging.config
+import os
+import sys
+
+import artifacts
+import declare
+import paymentfile
+
+
+
+SELFPATH = os.path.dirname(os.path.realpath(sys.argv[0]))
+
+
+
+def logging_getHandler(name):
+    for h in logging.getLogger().handlers:
+        if h.name == name:
+            return h
+    return None
+
+
+
+def parse_period(s):
+    return datetime.datetime.strptime(s, "%Y-%m").date()
+
+
+
+def add_months(d, n):
+    year, month = divmod(d.year * 12 + d.month - 1 + n, 12)
+    return datetime.date(year, month + 1, 1)
+
+
+
+def months(begin, end):
+    # First day of each month from begin to end included
+    d = begin
+    while d <= end:
+        yield d
+        d = add_months(d, 1)
+
+
+
+def declared_amounts(store, begin, end):
+    # The context returned by the URSSAF when paying is stored along with the
+    # PDF, it holds the amount that was actually declared
+    history = {}
+    for period in months(begin, end):
+        name = period.strftime("%Y_%m")
+        if store.lookup(name, "declaration_context.json") is None:
+            continue
+
+        try:
+            ctx = json.loads(store.read(name, "declaration_context.json"))
+            history[period] = int(ctx["data"]["declaration"]["ass"]["ass_autres"])
+        except (KeyError, TypeError, ValueError) as e:
+            logging.warning("Can't read the declaration context of %s: %r", name, e)
+
+    return history
+
+
+
+def compare(history, totals, begin, end):
+    problems = []
+    for period in months(begin, end):
+        expected = round(totals.get(period, 0))
+        declared = history.get(period)
+        if declared is None:
+            if expected > 0:
+                problems.append((period, "no stored declaration, %d€ in the paymentfile" % expected))
+        elif declared != expected:
+            problems.append((period, "declared %d€ but %d€ in the paymentfile" % (declared, expected)))
+
+    return problems
+
+
+
+def main():
+    locale.setlocale(locale.LC_ALL, '')
+    logging.config.fileConfig(os.path.join(SELFPATH, "logconf.ini"), disable_existing_loggers=False)
+
+    lastperiod, _ = declare.declaration_period()
+
+    parser = argparse.ArgumentParser(description="Compare les déclarations passées à l'URSSAF avec le paymentfile")
+    parser.add_argument("--payment", "-p", metavar="file", required=True, help="Fichier des factures payées")
+    parser.add_argument("--from", dest="begin", metavar="YYYY-MM", type=parse_period, help="Première période à vérifier (par défaut onze mois avant la dernière)")
+    parser.add_argument("--to", dest="end", metavar="YYYY-MM", type=parse_period, default=lastperiod, help="Dernière période à vérifier (par défaut le mois dernier)")
+    parser.add_argument("--ca-pdf-dir", "-c", metavar="dir", default=".", help="Répertoire où sont enregistrés les PDF de déclaration du chiffre d'affaire")
+    parser.add_argument("--verbose", "-v", action="count", default=0, help="Augmente le niveau de verbosité")
+    parser.add_argument("--quiet", "-q", action="count", default=0, help="Diminue le niveau de verbosité")
+
+    args = parser.parse_args()
+
+    verbose = args.verbose - args.quiet
+    payfile = args.payment
+    end = args.end
+    begin = args.begin or add_months(end, -11)
+    capdfdir = args.ca_pdf_dir
+
+    loglevels = ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"]
+    ch = logging_getHandler("consoleHandler")
+    curlevel = logging.getLevelName(ch.level)
+    curlevel = loglevels.index(curlevel)
+    verbose = min(len(loglevels) - 1, max(0, curlevel + verbose))
+    ch.setLevel(loglevels[verbose])
+
+    if begin > end:
+        parser.error("--from must not be after --to")
+
+    # Sum the payments of every month in a single pass
+    nextmonth = add_months(end, 1)
+    totals = paymentfile.PaymentFile(payfile).monthly_totals(begin, nextmonth)
+
+    store = artifacts.ArtifactStore(os.path.join(capdfdir, ".artifacts"))
+    history = declared_amounts(store, begin, end)
+
+    problems = compare(history, totals, begin, end)
+    for period, msg in problems:
+        print("%s: %s" % (period.strftime("%Y-%m"), msg))
+
+    if problems:
+        sys.exit(1)
+
+
+
+if __name__ == '__main__':
+    main()
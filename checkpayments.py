@@ -12,12 +12,15 @@ import logging
 import logging.config
 import os
 import sys
+import time
 import traceback
 
-import woob.core
-
+import digest
+import invoicefile
 import mailer
 import paymentfile
+import persist
+import statements
 
 
 
@@ -33,60 +36,24 @@ def logging_getHandler(name):
 
 
 
-class Invoice(object):
-    def __init__(self, invnum, invdate, duedate, amount):
-        self.invnum = invnum
-        self.invdate = datetime.datetime.strptime(invdate, "%d/%m/%Y").date()
-        self.duedate = datetime.datetime.strptime(duedate, "%d/%m/%Y").date()
-        self.amount = round(decimal.Decimal(amount), 2)
-
-    @classmethod
-    def fromfile(cls, filename):
-        keys = ["invoicenumber", "invoicedate", "deadline", "amount"]
-        data = {}
-
-        with open(filename) as fp:
-            for line in fp:
-                line = line.split("#")[0].rstrip()
-                if not line:
-                    logging.debug("Ignoring empty line")
-                    continue
-
-                k, v = line.split(" ", 1)
-                data[k] = v
-
-        missing = set(keys) - set(data)
-        if missing:
-            raise ValueError("Invoice file %s lacks fields %r" % (filename, list(missing)))
-
-        extra = set(data) - set(keys)
-        if extra:
-            logging.warning("Invoice file %s has extra fields %r", filename, list(extra))
+def bank_storage_path(statedir):
+    return os.path.join(statedir, "woob-storage.yaml")
 
-        logging.debug("Read invoice %r", data)
-        return cls(*[data[k] for k in keys])
 
-    def __str__(self):
-        d1 = self.invdate.strftime("%d/%m/%Y")
-        d2 = self.duedate.strftime("%d/%m/%Y")
-        return 'Invoice("%s", %s, %s, %s)' % (self.invnum, d1, d2, self.amount)
 
-    def __repr__(self):
-        return "<" + str(self) + ">"
-
-
-
-def read_invoices(invdir):
-    invlist = []
-    for f in glob.iglob(invdir + "/*.inv"):
-        invlist.append(Invoice.fromfile(f))
+def drop_bank_session(statedir):
+    try:
+        os.unlink(bank_storage_path(statedir))
+    except FileNotFoundError:
+        pass
 
-    invlist.sort(key=lambda inv: inv.invnum)
-    return invlist
 
 
+def load_bank(cfg, statedir=None):
+    # Loading woob is slow, don't do it when there's no open invoice
+    import woob.core
+    import woob.tools.storage
 
-def bank_transactions(cfg, since=None):
     class SilentProgress(woob.core.repositories.PrintProgress):
         def progress(self, percent, message):
             pass
@@ -103,22 +70,99 @@ def bank_transactions(cfg, since=None):
     boob.update(SilentProgress())
     args = json.loads(cfg["woobbackendargs"])
     args.update({"login": cfg["login"], "password": cfg["password"]})
-    bank = boob.load_backend(cfg["woobbackend"], None, args)
-    account = bank.get_account(cfg["accountno"])
 
+    # The browser state (cookies, tokens) is restored from the storage so that
+    # the bank doesn't see a new login on every run
+    storage = None
+    if statedir is not None:
+        os.makedirs(statedir, mode=0o700, exist_ok=True)
+        storage = woob.tools.storage.StandardStorage(bank_storage_path(statedir))
+
+    return boob.load_backend(cfg["woobbackend"], cfg["woobbackend"], args, storage=storage)
+
+
+
+def save_bank(bank):
+    if hasattr(bank.browser, "dump_state"):
+        bank.storage.set("browser_state", bank.browser.dump_state())
+        bank.storage.save()
+
+
+
+def account_history(bank, accountno, since=None):
+    account = bank.get_account(accountno)
     trans = bank.iter_history(account)
     if since is not None:
-        trans = list(itertools.takewhile(lambda x: x.date >= since, trans))
+        trans = itertools.takewhile(lambda x: x.date >= since, trans)
+    return list(trans)
+
+
+
+def session_rejected(e):
+    # Only these errors can come from a stored session that the bank doesn't
+    # accept anymore. A wrong password, a connection error or a request for
+    # an interactive authentication wouldn't be solved by a new login.
+    import woob.browser.exceptions
+    import woob.exceptions
+
+    if isinstance(e, (woob.browser.exceptions.LoggedOut, woob.exceptions.BrowserForbidden)):
+        return True
+    if isinstance(e, woob.browser.exceptions.ClientError):
+        return e.response is not None and e.response.status_code in (401, 403)
+    return False
+
+
+
+def bank_transactions(cfg, since=None, bank=None, statedir=None):
+    # A new session is only worth a retry if this one came from the storage
+    stored = statedir is not None and os.path.exists(bank_storage_path(statedir))
+    loaded = bank is None
+    if loaded:
+        bank = load_bank(cfg, statedir)
+
+    try:
+        trans = account_history(bank, cfg["accountno"], since)
+    except Exception as e:
+        if not stored or not session_rejected(e):
+            raise
+
+        # A bank object given by the caller is dropped by the caller
+        logging.warning("Bank rejected the stored session, forgetting it: %s", e)
+        drop_bank_session(statedir)
+        if not loaded:
+            raise
+
+        bank = load_bank(cfg, statedir)
+        trans = account_history(bank, cfg["accountno"], since)
+
+    save_bank(bank)
     return trans
 
 
 
+def transactions(config, since=None, bank=None, statedir=None, statement=None):
+    if statement is not None:
+        cfg = config["Statement"] if config.has_section("Statement") else None
+        return statements.iter_statement(statement, cfg, since)
+
+    return bank_transactions(config["Bank"], since=since, bank=bank, statedir=statedir)
+
+
+
+def candidate_transactions(invoices, trans):
+    # Only a transaction with the amount of an invoice can pay it. Dropping the
+    # other ones while streaming a statement keeps the memory bounded.
+    amounts = set(inv.amount for inv in invoices)
+    return (t for t in trans if t.amount in amounts)
+
+
+
 def match_transactions(invoices, trans):
     trans.sort(key=lambda t: t.date)
     matched = []
     for t in trans:
         for inv in invoices:
-            maxdate = inv.duedate + datetime.timedelta(days=366)
+            maxdate = inv.duedate + invoicefile.PAYMENT_DELAY
             if t.amount == inv.amount and t.date >= inv.invdate and t.date <= maxdate:
                 matched.append((inv, t))
                 invoices.remove(inv)
@@ -131,63 +175,304 @@ def match_transactions(invoices, trans):
 
 
 
-def dostuff(config, mailsender, invdir, payfile):
-    invoices = read_invoices(invdir)
+def match_transactions_bulk(invoices, trans):
+    # Same greedy assignment as match_transactions on columnar arrays: amounts
+    # in cents and dates as day ordinals. A transaction can only pay an
+    # invoice of the same amount, so each amount is matched independently.
+    import numpy
+
+    trans = sorted(trans, key=lambda t: t.date)
+    invamount = numpy.array([round(inv.amount * 100) for inv in invoices], dtype=numpy.int64)
+    invbegin = numpy.array([inv.invdate.toordinal() for inv in invoices], dtype=numpy.int64)
+    invend = numpy.array([(inv.duedate + invoicefile.PAYMENT_DELAY).toordinal() for inv in invoices], dtype=numpy.int64)
+    tamount = numpy.array([round(t.amount * 100) for t in trans], dtype=numpy.int64)
+    tdate = numpy.array([t.date.toordinal() for t in trans], dtype=numpy.int64)
+
+    used = numpy.zeros(len(invoices), dtype=bool)
+    pairs = []
+    for amount in numpy.intersect1d(invamount, tamount):
+        candidates = numpy.flatnonzero(invamount == amount)
+        for ti in numpy.flatnonzero(tamount == amount):
+            ok = ~used[candidates] & (invbegin[candidates] <= tdate[ti]) & (invend[candidates] >= tdate[ti])
+            if not ok.any():
+                continue
+
+            # The first invoice in the list order, like match_transactions
+            ii = candidates[numpy.argmax(ok)]
+            used[ii] = True
+            pairs.append((ti, ii))
+
+    pairs.sort()
+    matched = [(invoices[ii], trans[ti]) for ti, ii in pairs]
+    unmatched = [inv for inv, u in zip(invoices, used) if not u]
+    return matched, unmatched
+
+
+
+def backfill(config, invdir, payfile, statedir=None, statement=None):
+    # Rebuild the whole paymentfile from the complete bank history
+    invoices = [inv for inv in invoicefile.read_invoices(invdir) if inv.amount > 0]
+    if len(invoices) == 0:
+        logging.warning("No invoice to match")
+        return
+
+    since = min(inv.invdate for inv in invoices)
+    trans = transactions(config, since=since, statedir=statedir, statement=statement)
+    trans = list(candidate_transactions(invoices, trans))
+    logging.info("Matching %d invoices with %d transactions", len(invoices), len(trans))
+    matched, unmatched = match_transactions_bulk(invoices, trans)
+
+    payments = paymentfile.PaymentFile(payfile)
+    payments.rewrite([paymentfile.Payment.from_invoice_transaction(inv, t) for inv, t in matched])
+    logging.info("%d invoices matched, %d unmatched", len(matched), len(unmatched))
+
+
+
+def dostuff(config, mailsender, invdir, payfile, bank=None, statedir=None, statement=None):
+    invoices = invoicefile.read_invoices(invdir)
 
     # Read the paymentfile
     payments = paymentfile.PaymentFile(payfile)
 
+    reconcile(config, mailsender, invoices, payments, bank, statedir, statement)
+
+
+
+def reconcile(config, mailsender, invoices, payments, bank=None, statedir=None, statement=None):
     # Remove the invoices that are already in the paymentfile
     invoices = payments.filter_invoices(invoices)
     if len(invoices) == 0:
+        notify(config, mailsender, [], statedir)
         return
 
     # Check the bank account for new paid invoices and update the paymentfile
     since = min(inv.invdate for inv in invoices)
-    trans = bank_transactions(config["Bank"], since=since)
+    trans = transactions(config, since=since, bank=bank, statedir=statedir, statement=statement)
+    trans = candidate_transactions(invoices, trans)
 
     # Remove transaction that are already in the paymentfile
-    trans = payments.filter_transactions(trans)
+    trans = payments.filter_transactions(trans, config["Bank"].getfloat("labelsimilarity", paymentfile.LABEL_SIMILARITY))
 
     # Match the invoices and transactions
     matched, unmatched = match_transactions(invoices, trans)
     overdue = [inv for inv in unmatched if inv.duedate < datetime.date.today()]
 
     # Append matching in paymentfile
-    if len(matched) > 0 and not payfile:
+    if len(matched) > 0 and payments.path is None:
         logging.warning("No payment file to record matched invoices and transactions")
 
     for inv, t in matched:
         payments.add_payment(inv, t)
 
-    # Send a mail
+    notify(config, mailsender, notification_events(matched, overdue), statedir)
+
+
+
+def notification_events(matched, overdue):
+    events = []
+    for inv, t in matched:
+        text = "Invoice %s: %s€ " % (inv.invnum, inv.amount)
+        text += "to be paid between %s and %s\n" % (inv.invdate, inv.duedate)
+        text += "Transaction: %s %s€ " % (t.date, t.amount)
+        text += "%s\n" % t.label
+        events.append({"key": "matched:%s" % inv.invnum, "kind": "matched", "amount": str(inv.amount), "text": text})
+
+    for inv in overdue:
+        text = "Invoice %s for %s€ " % (inv.invnum, inv.amount)
+        text += "to be paid between %s and %s\n" % (inv.invdate, inv.duedate)
+        events.append({"key": "overdue:%s" % inv.invnum, "kind": "overdue", "amount": str(inv.amount), "text": text})
+
+    return events
+
+
+
+def notification_mail(events):
+    matched = [e for e in events if e["kind"] == "matched"]
+    overdue = [e for e in events if e["kind"] == "overdue"]
+
     titles = []
     msg = ""
     if len(matched) > 0:
-        amount = sum(inv.amount for inv, _ in matched)
+        amount = sum(decimal.Decimal(e["amount"]) for e in matched)
         titles.append("Invoice matching (%s€)" % amount)
         msg += "The following invoices and bank transactions have been matched:\n"
-        for inv, t in matched:
-            msg += "Invoice %s: %s€ " % (inv.invnum, inv.amount)
-            msg += "to be paid between %s and %s\n" % (inv.invdate, inv.duedate)
-            msg += "Transaction: %s %s€ " % (t.date, t.amount)
-            msg += "%s\n" % t.label
+        for e in matched:
+            msg += e["text"]
             msg += "\n"
 
     if len(overdue) > 0:
-        amount = sum(inv.amount for inv in overdue)
+        amount = sum(decimal.Decimal(e["amount"]) for e in overdue)
         if len(overdue) == 1:
             titles.append("Overdue invoice (%s€)" % amount)
         else:
             titles.append("%d overdue invoices (%s€)" % (len(overdue), amount))
 
         msg += "The following invoices are overdue:\n"
-        for inv in overdue:
-            msg += "Invoice %s for %s€ " % (inv.invnum, inv.amount)
-            msg += "to be paid between %s and %s\n" % (inv.invdate, inv.duedate)
+        for e in overdue:
+            msg += e["text"]
+
+    return " + ".join(titles), msg
+
+
+
+def notify(config, mailsender, events, statedir=None):
+    cfg = config["Bank"]
+
+    def send(events):
+        title, msg = notification_mail(events)
+        mailsender.message(cfg["email"], title, msg)
+
+    # Without a digest window, send the notifications right away
+    window = cfg.getfloat("digestwindow", 0) * 3600
+    if window <= 0 or statedir is None:
+        if len(events) > 0:
+            send(events)
+        return
 
-    if msg != "":
-        mailsender.message(config["Bank"]["email"], " + ".join(titles), msg)
+    repeat = cfg.getfloat("digestrepeat", 7) * 86400
+    d = digest.Digest(os.path.join(statedir, "digest.json"), window, repeat)
+    # The overdue invoices of this run supersede the pending ones, some of
+    # them may have been paid since
+    d.add(events, replace=("overdue",))
+    d.flush(send)
+
+
+
+class InvoiceWatcher(object):
+    def __init__(self, invdir, payfile):
+        # inotify loads libc with ctypes, only pay for it in watch mode
+        import inotify
+
+        self.mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM | inotify.IN_DELETE
+        self._invdir = invdir
+        self._payfile = payfile
+        self._ledger = os.path.isfile(invdir)
+
+        # Open invoices already looked for in the bank transactions and
+        # invoices modified since then
+        self._open = set()
+        self._changed = set()
+
+        self._invoices = {}
+        if self._ledger:
+            self._read_ledger()
+        else:
+            for f in glob.iglob(invdir + "/*.inv"):
+                inv = invoicefile.Invoice.fromfile(f)
+                self._invoices[os.path.join(invdir, os.path.basename(f))] = inv
+                self._changed.add(inv.invnum)
+        self._payments = paymentfile.PaymentFile(payfile)
+
+        # Watch the directories since editors usually replace the files
+        self._notifier = inotify.Inotify()
+        if self._ledger:
+            self._invwatch = os.path.dirname(os.path.abspath(invdir))
+        else:
+            self._invwatch = os.path.abspath(invdir)
+        self._notifier.add_watch(self._invwatch, self.mask | inotify.IN_ONLYDIR)
+
+        self._paydir = None
+        if payfile is not None:
+            self._paydir = os.path.dirname(os.path.abspath(payfile))
+            self._notifier.add_watch(self._paydir, self.mask | inotify.IN_ONLYDIR)
+
+    @property
+    def payments(self):
+        return self._payments
+
+    def invoices(self):
+        return sorted(self._invoices.values(), key=lambda inv: inv.invnum)
+
+    def _invoice_event(self, path, mask):
+        import inotify
+
+        if mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            self._invoices.pop(path, None)
+            logging.info("Invoice file %s removed", path)
+            return
+
+        try:
+            inv = invoicefile.Invoice.fromfile(path)
+        except (OSError, ValueError) as e:
+            logging.warning("Can't read invoice file %s: %s", path, e)
+            return
+
+        logging.info("Invoice file %s changed: %s", path, inv)
+        old = self._invoices.get(path)
+        self._invoices[path] = inv
+        if old is None or str(old) != str(inv):
+            self._changed.add(inv.invnum)
+
+    def _read_ledger(self):
+        # The ledger is a single file, read it again and compare the invoices
+        invoices = {}
+        for inv in invoicefile.iter_ledger(self._invdir):
+            invoices[inv.invnum] = inv
+            old = self._invoices.get(inv.invnum)
+            if old is None or str(old) != str(inv):
+                self._changed.add(inv.invnum)
+        self._invoices = invoices
+
+    def wait(self, timeout=None):
+        for path, mask, name in self._notifier.read(timeout):
+            if path == self._invwatch and self._ledger and name == os.path.basename(self._invdir):
+                logging.info("Invoice ledger changed, reading it again")
+                try:
+                    self._read_ledger()
+                except (OSError, ValueError) as e:
+                    logging.warning("Can't read invoice ledger %s: %s", self._invdir, e)
+            elif path == self._invwatch and not self._ledger and name.endswith(".inv"):
+                self._invoice_event(os.path.join(self._invdir, name), mask)
+            elif path == self._paydir and name == os.path.basename(self._payfile):
+                logging.info("Paymentfile changed, reading it again")
+                self._payments = paymentfile.PaymentFile(self._payfile)
+
+    def open_invoices(self):
+        return set(inv.invnum for inv in self._payments.filter_invoices(self._invoices.values()))
+
+    def has_new(self):
+        opened = self.open_invoices()
+        return bool((opened - self._open) | (opened & self._changed))
+
+    def done(self):
+        self._open = self.open_invoices()
+        self._changed.clear()
+
+
+
+def send_error(mailsender, to, msg):
+    msg += traceback.format_exc()
+    logs = logging_getHandler("memoryHandler").getvalue().encode()
+    mailsender.error(to, msg, attachments=[("debug.log", logs)])
+
+
+
+def watch(config, mailsender, invdir, payfile, interval, errormail=True, statedir=None, statement=None):
+    watcher = InvoiceWatcher(invdir, payfile)
+    bank = None
+    lastpass = None
+
+    while True:
+        due = interval > 0 and lastpass is not None and time.monotonic() >= lastpass + interval
+        if watcher.has_new() or (due and watcher.open_invoices()):
+            try:
+                if bank is None and statement is None:
+                    bank = load_bank(config["Bank"], statedir)
+                reconcile(config, mailsender, watcher.invoices(), watcher.payments, bank, statedir, statement)
+            except Exception:
+                logging.exception("Reconciliation failed:")
+                bank = None
+                if errormail:
+                    msg = "Exception caught while trying to match the payments with invoices.\n\n"
+                    send_error(mailsender, config["SMTP"].get("smtpuser"), msg)
+
+            watcher.done()
+            lastpass = time.monotonic()
+
+        timeout = None
+        if interval > 0 and watcher.open_invoices():
+            timeout = max(0, lastpass + interval - time.monotonic())
+        watcher.wait(timeout)
 
 
 
@@ -198,8 +483,14 @@ def main():
 
     parser = argparse.ArgumentParser(description="Programme de rapprochement bancaire")
     parser.add_argument("cfgfile", metavar="configfile", help="Fichier de configuration")
-    parser.add_argument("--invoice-dir", "-i", metavar="dir", help="Répertoire contenant les fichiers .inv")
+    parser.add_argument("--invoice-dir", "-i", metavar="dir", help="Répertoire contenant les fichiers .inv ou registre des factures (.jsonl ou .csv)")
     parser.add_argument("--payment", "-p", metavar="file", help="Fichier des factures payées")
+    parser.add_argument("--statement", "-s", metavar="file", help="Relevé bancaire exporté (OFX, QFX ou CSV) à utiliser à la place du site de la banque")
+    parser.add_argument("--state-dir", metavar="dir", default=persist.default_dir(), help="Répertoire où conserver l'état entre deux exécutions")
+    parser.add_argument("--backfill", action="store_true", help="Reconstruit entièrement le paymentfile à partir de tout l'historique bancaire (l'ancien est conservé en .bak)")
+    parser.add_argument("--watch", action="store_true", help="Surveille les factures et le paymentfile et refait le rapprochement quand ils changent")
+    parser.add_argument("--watch-interval", metavar="hours", type=float, default=24, help="Délai maximum entre deux rapprochements en mode --watch tant qu'il reste des factures ouvertes (0 pour désactiver)")
+    parser.add_argument("--profile", metavar="dir", nargs="?", const=".", help="Profile l'exécution et enregistre le résultat dans ce répertoire, il est aussi joint au mail")
     parser.add_argument("--no-error-mail", action="store_true", help="N'envoie pas de mail pour les erreurs")
     parser.add_argument("--verbose", "-v", action="count", default=0, help="Augmente le niveau de verbosité")
     parser.add_argument("--quiet", "-q", action="count", default=0, help="Diminue le niveau de verbosité")
@@ -210,7 +501,13 @@ def main():
     verbose = args.verbose - args.quiet
     invdir = args.invoice_dir
     payfile = args.payment
+    statedir = args.state_dir
+    statement = args.statement
+    backfillmode = args.backfill
+    watchmode = args.watch
+    watchinterval = args.watch_interval * 3600
     errormail = not args.no_error_mail
+    profiledir = args.profile
 
     loglevels = ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"]
     ch = logging_getHandler("consoleHandler")
@@ -223,18 +520,28 @@ def main():
     config = configparser.ConfigParser()
     config.read(configpath)
 
-    smtphost = config["SMTP"]["smtphost"]
-    smtpport = config["SMTP"].get("smtpport")
-    smtpauth = config["SMTP"].get("smtpauthmethod")
     smtpuser = config["SMTP"].get("smtpuser")
-    smtppassword = config["SMTP"].get("smtppwd")
-    smtpoauthcmd = config["SMTP"].get("smtpoauthtokencmd")
+    mailsender = mailer.Mailer.from_config(config["SMTP"])
 
-    mailsender = mailer.Mailer(smtphost, smtpport, smtpauth,
-                               smtpuser, smtppassword, smtpoauthcmd)
+    if watchmode and invdir is None:
+        parser.error("--watch requires --invoice-dir")
+    if backfillmode and (invdir is None or payfile is None):
+        parser.error("--backfill requires --invoice-dir and --payment")
+
+    prof = None
+    if profiledir is not None:
+        import profiling
+        prof = profiling.Profiler()
+        mailsender.add_attachments_hook(prof.attachments)
+        prof.start()
 
     try:
-        dostuff(config, mailsender, invdir, payfile)
+        if backfillmode:
+            backfill(config, invdir, payfile, statedir, statement)
+        elif watchmode:
+            watch(config, mailsender, invdir, payfile, watchinterval, errormail, statedir, statement)
+        else:
+            dostuff(config, mailsender, invdir, payfile, statedir=statedir, statement=statement)
     except KeyboardInterrupt:
         pass
     except:
@@ -243,9 +550,12 @@ def main():
             raise
 
         msg = "Exception caught while trying to match the payments with invoices.\n\n"
-        msg += traceback.format_exc()
-        logs = logging_getHandler("memoryHandler").stream.getvalue().encode()
-        mailsender.error(smtpuser, msg, attachments=[("debug.log", logs)])
+        send_error(mailsender, smtpuser, msg)
+    finally:
+        if prof is not None:
+            prof.stop()
+            prof.dump(profiledir, "checkpayments")
+        mailsender.close()
 
 
 
@@ -0,0 +1,71 @@
+import datetime
+
+
+
+class CronSchedule(object):
+    # minute, hour, day of month, month, day of week (Sunday is 0 or 7)
+    fields = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expr):
+        parts = expr.split()
+        if len(parts) != 5:
+            raise ValueError("Cron schedule must have 5 fields: %r" % expr)
+
+        self.expr = expr
+        self._sets = [self._parse_field(p, lo, hi) for p, (lo, hi) in zip(parts, self.fields)]
+        # Like cron, when both days are restricted, any of them matching is enough
+        self._dom_any = parts[2] == "*"
+        self._dow_any = parts[4] == "*"
+
+    @staticmethod
+    def _parse_field(field, lo, hi):
+        values = set()
+        for item in field.split(","):
+            rng, _, step = item.partition("/")
+            step = int(step) if step else 1
+            if rng == "*":
+                start, end = lo, hi
+            elif "-" in rng:
+                start, end = map(int, rng.split("-"))
+            else:
+                start = end = int(rng)
+                if step != 1:
+                    end = hi
+
+            if start < lo or end > hi or start > end or step < 1:
+                raise ValueError("Invalid cron field %r" % field)
+            values.update(range(start, end + 1, step))
+
+        # Sunday can be written 7
+        if hi == 7 and 7 in values:
+            values.discard(7)
+            values.add(0)
+        return values
+
+    def _day_matches(self, d):
+        dom = d.day in self._sets[2]
+        dow = d.isoweekday() % 7 in self._sets[4]
+        if self._dom_any or self._dow_any:
+            return dom and dow
+        return dom or dow
+
+    def next_after(self, dt):
+        minutes, hours, _, months, _ = self._sets
+        dt = dt.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = dt + datetime.timedelta(days=5 * 366)
+
+        while dt < limit:
+            if dt.month not in months:
+                month = dt.month % 12 + 1
+                year = dt.year + (dt.month == 12)
+                dt = dt.replace(year=year, month=month, day=1, hour=0, minute=0)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif dt.hour not in hours:
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+            elif dt.minute not in minutes:
+                dt += datetime.timedelta(minutes=1)
+            else:
+                return dt
+
+        raise ValueError("Cron schedule %r never matches" % self.expr)
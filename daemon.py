@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+import argparse
+import configparser
+import datetime
+import glob
+import json
+import locale
+import logging
+import logging.config
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+import checkpayments
+import cron
+import declare
+import invoicefile
+import mailer
+import paymentfile
+import persist
+import urssaf
+
+
+
+SELFPATH = os.path.dirname(os.path.realpath(sys.argv[0]))
+
+
+
+def logging_getHandler(name):
+    for h in logging.getLogger().handlers:
+        if h.name == name:
+            return h
+    return None
+
+
+
+class FileCache(object):
+    # The invoices and the paymentfile are only parsed again when one of the
+    # files has been added, removed or modified since the last job
+    def __init__(self, invdir, payfile):
+        self._invdir = invdir
+        self._payfile = payfile
+        self._signature = None
+        self._invoices = None
+        self._payments = None
+
+    def _stat(self):
+        paths = []
+        if self._invdir is not None and os.path.isfile(self._invdir):
+            paths.append(self._invdir)
+        elif self._invdir is not None:
+            paths.extend(sorted(glob.iglob(self._invdir + "/*.inv")))
+        if self._payfile is not None:
+            paths.append(self._payfile)
+
+        sig = []
+        for p in paths:
+            try:
+                st = os.stat(p)
+            except FileNotFoundError:
+                continue
+            sig.append((p, st.st_mtime_ns, st.st_size))
+        return sig
+
+    def get(self):
+        sig = self._stat()
+        if sig != self._signature:
+            logging.info("Invoices or paymentfile changed, reading them again")
+            self._invoices = []
+            if self._invdir is not None:
+                self._invoices = invoicefile.read_invoices(self._invdir)
+            self._payments = paymentfile.PaymentFile(self._payfile)
+            self._signature = sig
+        else:
+            logging.debug("Reusing the parsed invoices and paymentfile")
+
+        return list(self._invoices), self._payments
+
+
+
+class Job(object):
+    def __init__(self, name, schedule, func):
+        self.name = name
+        self.schedule = cron.CronSchedule(schedule)
+        self.func = func
+        self.next_run = self.schedule.next_after(datetime.datetime.now())
+        self.last_run = None
+        self.last_result = None
+        self.last_duration = None
+        self.running = False
+
+    def status(self):
+        return {
+            "schedule": self.schedule.expr,
+            "next_run": self.next_run.isoformat(),
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+            "last_result": self.last_result,
+            "last_duration": self.last_duration,
+            "running": self.running,
+        }
+
+
+
+class Daemon(object):
+    def __init__(self, config, mailsender, invdir, payfile, pdfdir, statedir, errormail=True):
+        self._config = config
+        self._mailsender = mailsender
+        self._pdfdir = pdfdir
+        self._statedir = statedir
+        self._errormail = errormail
+        self._files = FileCache(invdir, payfile)
+        self._bank = None
+        self._urss = None
+        self._stop = threading.Event()
+        self._started = datetime.datetime.now()
+
+        self._jobs = []
+        schedules = config["Daemon"] if config.has_section("Daemon") else {}
+        if "checkpayments" in schedules:
+            self._jobs.append(Job("checkpayments", schedules["checkpayments"], self._checkpayments))
+        if "declare" in schedules:
+            self._jobs.append(Job("declare", schedules["declare"], self._declare))
+
+        if not self._jobs:
+            raise ValueError("No job scheduled in section [Daemon]")
+
+    def _checkpayments(self):
+        invoices, payments = self._files.get()
+        if len(payments.filter_invoices(invoices)) == 0:
+            logging.info("No open invoice")
+            checkpayments.notify(self._config, self._mailsender, [], self._statedir)
+            return "nothing to match"
+
+        if self._bank is None:
+            logging.info("Loading bank backend")
+            self._bank = checkpayments.load_bank(self._config["Bank"], self._statedir)
+
+        try:
+            checkpayments.reconcile(self._config, self._mailsender, invoices, payments, self._bank, self._statedir)
+        except:
+            # The bank session might be in a bad state
+            self._bank = None
+            raise
+        return "ok"
+
+    def _declare(self):
+        _, payments = self._files.get()
+
+        if self._urss is not None and not self._urss.logged_in():
+            logging.info("URSSAF session expired")
+            self._urss = None
+
+        # dostuff() only logs in if the journal doesn't show the period as paid
+        try:
+            self._urss = declare.dostuff(self._config, self._mailsender, None, self._pdfdir,
+                                         statedir=self._statedir, urss=self._urss, payments=payments)
+        except urssaf.AlreadyPaidError:
+            logging.info("Already declared with correct amount. Ignoring.")
+            return "already declared"
+        except:
+            self._urss = None
+            raise
+        return "ok"
+
+    def _run(self, job):
+        memhandler = logging_getHandler("memoryHandler")
+        if memhandler is not None:
+            memhandler.clear()
+
+        logging.info("Running job %s", job.name)
+        job.running = True
+        job.last_run = datetime.datetime.now()
+        start = time.monotonic()
+        try:
+            job.last_result = job.func()
+        except Exception as e:
+            logging.exception("Exception in job %s:", job.name)
+            job.last_result = "error: %s" % e
+            if self._errormail:
+                self._error_mail(job)
+        finally:
+            job.running = False
+            job.last_duration = round(time.monotonic() - start, 3)
+
+        logging.info("Job %s done in %.1fs: %s", job.name, job.last_duration, job.last_result)
+
+    def _error_mail(self, job):
+        msg = "Exception caught while running the job %s.\n\n" % job.name
+        msg += traceback.format_exc()
+        logs = logging_getHandler("memoryHandler").getvalue().encode()
+        try:
+            self._mailsender.error(self._config["SMTP"].get("smtpuser"), msg, attachments=[("debug.log", logs)])
+        except Exception:
+            logging.exception("Can't send the error mail:")
+
+    def status(self):
+        return {
+            "pid": os.getpid(),
+            "started": self._started.isoformat(),
+            "bank_loaded": self._bank is not None,
+            "urssaf_logged_in": self._urss is not None and self._urss.logged_in(),
+            "jobs": {job.name: job.status() for job in self._jobs},
+        }
+
+    def serve_status(self, path):
+        daemon = self
+
+        class StatusHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.wfile.write(json.dumps(daemon.status(), indent=4).encode() + b"\n")
+
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socketserver.ThreadingUnixStreamServer(path, StatusHandler)
+        os.chmod(path, 0o600)
+        thread = threading.Thread(target=server.serve_forever, name="status", daemon=True)
+        thread.start()
+        logging.info("Status available on socket %s", path)
+        return server
+
+    def stop(self, *args):
+        logging.info("Stopping")
+        self._stop.set()
+
+    def run(self):
+        for job in self._jobs:
+            logging.info("Job %s scheduled at %s", job.name, job.next_run)
+
+        while not self._stop.is_set():
+            job = min(self._jobs, key=lambda j: j.next_run)
+            wait = (job.next_run - datetime.datetime.now()).total_seconds()
+            if wait > 0:
+                # Wake up regularly in case the clock jumped (suspend, DST)
+                self._stop.wait(min(wait, 60))
+                continue
+
+            self._run(job)
+            job.next_run = job.schedule.next_after(datetime.datetime.now())
+            logging.info("Next run of job %s at %s", job.name, job.next_run)
+
+
+
+def print_status(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    with sock, sock.makefile("rb") as fp:
+        sys.stdout.write(fp.read().decode())
+
+
+
+def main():
+    locale.setlocale(locale.LC_ALL, '')
+    logging.config.fileConfig(os.path.join(SELFPATH, "logconf.ini"), disable_existing_loggers=False)
+
+    parser = argparse.ArgumentParser(description="Lance le rapprochement bancaire et la déclaration selon un planning")
+    parser.add_argument("cfgfile", metavar="configfile", help="Fichier de configuration")
+    parser.add_argument("--invoice-dir", "-i", metavar="dir", help="Répertoire contenant les fichiers .inv ou registre des factures (.jsonl ou .csv)")
+    parser.add_argument("--payment", "-p", metavar="file", help="Fichier des factures payées")
+    parser.add_argument("--ca-pdf-dir", "-c", metavar="dir", default=".", help="Répertoire où enregistrer le PDF de déclaration du chiffre d'affaire")
+    parser.add_argument("--state-dir", metavar="dir", default=persist.default_dir(), help="Répertoire où conserver l'état entre deux exécutions")
+    parser.add_argument("--status-socket", metavar="path", help="Socket unix donnant l'état du démon (par défaut dans le répertoire d'état)")
+    parser.add_argument("--status", action="store_true", help="Affiche l'état du démon en cours d'exécution")
+    parser.add_argument("--no-error-mail", action="store_true", help="N'envoie pas de mail pour les erreurs")
+    parser.add_argument("--verbose", "-v", action="count", default=0, help="Augmente le niveau de verbosité")
+    parser.add_argument("--quiet", "-q", action="count", default=0, help="Diminue le niveau de verbosité")
+
+    args = parser.parse_args()
+
+    configpath = args.cfgfile
+    verbose = args.verbose - args.quiet
+    invdir = args.invoice_dir
+    payfile = args.payment
+    capdfdir = args.ca_pdf_dir
+    statedir = args.state_dir
+    statussock = args.status_socket or os.path.join(statedir, "daemon.sock")
+    errormail = not args.no_error_mail
+
+    if args.status:
+        print_status(statussock)
+        return
+
+    loglevels = ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"]
+    ch = logging_getHandler("consoleHandler")
+    curlevel = logging.getLevelName(ch.level)
+    curlevel = loglevels.index(curlevel)
+    verbose = min(len(loglevels) - 1, max(0, curlevel + verbose))
+    ch.setLevel(loglevels[verbose])
+
+    logging.info("Reading config file %s", configpath)
+    config = configparser.ConfigParser()
+    config.read(configpath)
+
+    mailsender = mailer.Mailer.from_config(config["SMTP"])
+    daemon = Daemon(config, mailsender, invdir, payfile, capdfdir, statedir, errormail)
+
+    signal.signal(signal.SIGTERM, daemon.stop)
+    os.makedirs(statedir, mode=0o700, exist_ok=True)
+    server = daemon.serve_status(statussock)
+
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.unlink(statussock)
+        mailsender.close()
+
+
+
+if __name__ == '__main__':
+    main()
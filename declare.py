@@ -8,17 +8,21 @@ import locale
 import logging
 import logging.config
 import os
-import subprocess
 import sys
 import traceback
 
+import artifacts
+import httptrace
+import journal
 import mailer
 import paymentfile
+import persist
 import urssaf
 
 
 
 SELFPATH = os.path.dirname(os.path.realpath(sys.argv[0]))
+RATES_MAX_AGE = datetime.timedelta(days=62)
 
 
 
@@ -30,9 +34,10 @@ def logging_getHandler(name):
 
 
 
-def get_payments(payfile, begin, end):
+def get_payments(payfile, begin, end, payments=None):
     # Parse Paymentfile
-    payments = paymentfile.PaymentFile(payfile)
+    if payments is None:
+        payments = paymentfile.PaymentFile(payfile)
 
     # Select the payments of last month
     pay = payments.payments_in_range(begin, end)
@@ -55,7 +60,7 @@ def get_payments(payfile, begin, end):
 
 
 
-def tax_message(taxes, taxes_total, mandate):
+def tax_message(taxes, taxes_total, mandate=None):
     taxes = [t for t in taxes if t["amount"] > 0]
     if len(taxes) == 0:
         msg = "\nNo taxes.\n"
@@ -68,6 +73,8 @@ def tax_message(taxes, taxes_total, mandate):
 
     if taxes_total > 0:
         msg += "Total taxes to be paid: %d€\n" % taxes_total
+
+    if taxes_total > 0 and mandate is not None:
         msg += "\nThis amount will be paid from :\n"
         msg += "Bank: %s\n" % mandate["bank_name"]
         msg += "IBAN: %s\n" % mandate["IBAN"]
@@ -76,32 +83,101 @@ def tax_message(taxes, taxes_total, mandate):
 
 
 
-def dostuff(config, mailsender, payfile, pdfdir, redo="never"):
-    # Range of dates to consider
+def declaration_period():
     end = datetime.date.today().replace(day=1)
     begin = (end - datetime.timedelta(days=1)).replace(day=1)
+    return begin, end
+
+
+
+def save_rates(statedir, period, taxes, total):
+    # Taxes that don't apply have a rate but a zero amount, which can't be told
+    # apart when nothing was declared
+    if statedir is None or total <= 0:
+        return
+
+    rates = {
+        "date": datetime.date.today().isoformat(),
+        "period": period,
+        "taxes": [{"desc": t["desc"], "rate": t["rate"]} for t in taxes if t["amount"] > 0],
+    }
+    path = os.path.join(statedir, "rates.json")
+    logging.debug("Saving tax rates to %r", path)
+    persist.write_json(path, rates)
+
+
+
+def estimate(payfile, statedir):
+    begin, end = declaration_period()
     total, msg = get_payments(payfile, begin, end)
 
-    pdfname = begin.strftime("CA_%Y_%m.pdf")
-    pdfpath = "%s/%s" % (pdfdir, pdfname)
+    rates = persist.read_json(os.path.join(statedir, "rates.json"))
+    if rates is None:
+        raise RuntimeError("No cached tax rates. They are saved by the first declaration.")
+
+    taxes = []
+    for r in rates["taxes"]:
+        amount = round(float(total) * r["rate"] / 100)
+        taxes.append({"desc": r["desc"], "rate": r["rate"], "amount": amount})
+    taxes_total = sum(t["amount"] for t in taxes)
+
+    msg += "\nEstimated with the tax rates of %s.\n" % rates["date"]
+    ratesdate = datetime.date.fromisoformat(rates["date"])
+    if ratesdate < datetime.date.today() - RATES_MAX_AGE or ratesdate.year != begin.year:
+        msg += "WARNING: These tax rates are stale, the actual amount may differ.\n"
+
+    msg += tax_message(taxes, taxes_total)
+    return msg
+
+
 
-    if os.path.isfile(pdfpath):
-        filetype = subprocess.check_output(["file", "-b", "--mime-type", pdfpath])
-        filetype = filetype.decode().rstrip()
-        if not filetype.startswith("application/pdf"):
-            logging.warning("File %r does not look like a PDF. Has mime type %r", pdfpath, filetype)
+def dostuff(config, mailsender, payfile, pdfdir, redo="never", statedir=None, trace=None, urss=None, payments=None, verify=False):
+    # Range of dates to consider
+    begin, end = declaration_period()
+    total, msg = get_payments(payfile, begin, end, payments)
+
+    period = begin.strftime("%Y_%m")
+    pdfname = begin.strftime("CA_%Y_%m.pdf")
+    pdfpath = os.path.join(pdfdir, pdfname)
+    store = artifacts.ArtifactStore(os.path.join(pdfdir, ".artifacts"))
+
+    entry = store.lookup(period, pdfname)
+    if entry is None and os.path.isfile(pdfpath):
+        # PDF saved before the artifact store existed
+        if artifacts.has_magic(pdfpath, artifacts.PDF_MAGIC):
+            logging.info("Indexing existing PDF %r", pdfpath)
+            store.add_file(period, pdfname, pdfpath)
+        else:
+            logging.warning("File %r does not look like a PDF.", pdfpath)
             logging.warning("Redoing declaration from scratch.")
             redo = "always"
 
-    elif redo != "always":
+    elif entry is None and redo != "always":
         logging.warning("No PDF summary. Forcing the redeclaration in order to complete it.")
         redo = "always"
 
     logging.debug("Declaration summary:\n%s", msg)
 
+    amount = round(total)
+    snapshot = None
+    log = None
+    if statedir is not None:
+        snapshot = os.path.join(statedir, "snapshots", period + ".json")
+        log = journal.Journal(os.path.join(statedir, "journal", period + ".jsonl"))
+
+    # No need to log in if the journal says it's all done
+    if log is not None and redo != "always" and not verify:
+        entry = log.paid(amount)
+        if entry is not None:
+            logging.info("Journal %r shows %d€ paid on %s", log.path, amount, entry["time"])
+            raise urssaf.AlreadyPaidError("Already declared and paid the right amount according to the journal.")
+
     # Declare on the URSSAF
     urssafcfg = config["URSSAF"]
-    urss = urssaf.URSSAF(urssafcfg["login"], urssafcfg["password"])
+    if urss is None:
+        urss = urssaf.URSSAF(urssafcfg["login"], urssafcfg["password"], snapshot=snapshot, trace=trace)
+    else:
+        urss.reset(snapshot)
 
     if len(urss.get_mandates()) == 0:
         raise RuntimeError("No registered mandate to pay with. Use the website for this.")
@@ -109,27 +185,49 @@ def dostuff(config, mailsender, payfile, pdfdir, redo="never"):
     # TODO: Maybe allow to choose which mandate to pay from?
     mandate = urss.get_mandates()[0]
 
-    taxes, taxes_total = urss.declare(total, redo)
+    try:
+        if urss.resume(total) is None:
+            taxes, taxes_total = urss.declare(total, redo)
+        else:
+            taxes, taxes_total = urss.taxes()
+    except urssaf.AlreadyPaidError:
+        if log is not None:
+            log.record("paid", amount=amount, reference=None)
+        raise
+
+    if log is not None:
+        log.record("declared", amount=amount, taxes=taxes_total)
+
+    save_rates(statedir, period, taxes, total)
     msg += tax_message(taxes, taxes_total, mandate)
     logging.debug("Message to be send by e-mail:\n%s", msg)
 
-    urss.validate_declaration()
+    if urss.state == "declared":
+        urss.validate_declaration()
+        if log is not None:
+            log.record("validated", amount=amount, taxes=taxes_total)
+
     ctx, pdfurl = urss.pay(mandate)
+    if log is not None:
+        log.record("paid", amount=amount, taxes=taxes_total, reference=pdfurl)
 
     # We need to be authenticated and send the 'Authorization' header to download the PDF
-    pdf = urss.get_auth(pdfurl).content
-
     logging.info("Saving PDF declaration as %r", pdfpath)
-    mode = "wb" if redo != "never" else "xb"
-    with open(pdfpath, mode) as fp:
-        fp.write(pdf)
+    with urss.step("download"), urss.get_auth(pdfurl, stream=True) as res:
+        chunks = res.iter_content(chunk_size=artifacts.CHUNK_SIZE)
+        store.add(period, pdfname, chunks, magic=artifacts.PDF_MAGIC, replace=(redo != "never"))
+    store.link(period, pdfname, pdfpath)
 
     ctxjson = json.dumps(ctx, indent=8).encode("utf-8")
-    att = [("declaration_context.json", ctxjson), (pdfname, pdf)]
+    store.add(period, "declaration_context.json", [ctxjson])
+    att = [("declaration_context.json", ctxjson), (pdfname, store.read(period, pdfname))]
 
     title = "Declared %d€, paid %d€" % (int(total), int(taxes_total))
     mailsender.message(urssafcfg["email"], title, msg, att)
 
+    # The session is only created when needed, let the caller keep it
+    return urss
+
 
 
 def main():
@@ -141,6 +239,11 @@ def main():
     parser.add_argument("--payment", "-p", metavar="file", help="Fichier des factures payées")
     parser.add_argument("--ca-pdf-dir", "-c", metavar="dir", default=".", help="Répertoire où enregistrer le PDF de déclaration du chiffre d'affaire")
     parser.add_argument("--redo-declaration", "--redo", choices=["never", "ifchanged", "always"], nargs="?", const="always", default="never", help="Refait la déclaration si elle existe déjà")
+    parser.add_argument("--state-dir", metavar="dir", default=persist.default_dir(), help="Répertoire où conserver l'état entre deux exécutions")
+    parser.add_argument("--verify-server", action="store_true", help="Interroge l'URSSAF même si le journal indique que la déclaration est déjà payée")
+    parser.add_argument("--estimate", action="store_true", help="Estime les cotisations dues à partir des derniers taux connus, sans se connecter")
+    parser.add_argument("--trace", metavar="file", help="Enregistre une trace JSON de chaque requête HTTP dans ce fichier")
+    parser.add_argument("--profile", metavar="dir", nargs="?", const=".", help="Profile l'exécution et enregistre le résultat dans ce répertoire, il est aussi joint au mail")
     parser.add_argument("--no-error-mail", action="store_true", help="N'envoie pas de mail pour les erreurs")
     parser.add_argument("--verbose", "-v", action="count", default=0, help="Augmente le niveau de verbosité")
     parser.add_argument("--quiet", "-q", action="count", default=0, help="Diminue le niveau de verbosité")
@@ -152,7 +255,12 @@ def main():
     payfile = args.payment
     capdfdir = args.ca_pdf_dir
     redo = args.redo_declaration
+    statedir = args.state_dir
+    estimateonly = args.estimate
+    verify = args.verify_server
+    tracefile = args.trace
     errormail = not args.no_error_mail
+    profiledir = args.profile
 
     loglevels = ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"]
     ch = logging_getHandler("consoleHandler")
@@ -161,22 +269,34 @@ def main():
     verbose = min(len(loglevels) - 1, max(0, curlevel + verbose))
     ch.setLevel(loglevels[verbose])
 
+    if estimateonly:
+        try:
+            print(estimate(payfile, statedir), end="")
+        except RuntimeError as e:
+            logging.error("%s", e)
+            sys.exit(1)
+        return
+
     logging.info("Reading config file %s", configpath)
     config = configparser.ConfigParser()
     config.read(configpath)
 
-    smtphost = config["SMTP"]["smtphost"]
-    smtpport = config["SMTP"].get("smtpport")
-    smtpauth = config["SMTP"].get("smtpauthmethod")
     smtpuser = config["SMTP"].get("smtpuser")
-    smtppassword = config["SMTP"].get("smtppwd")
-    smtpoauthcmd = config["SMTP"].get("smtpoauthtokencmd")
+    mailsender = mailer.Mailer.from_config(config["SMTP"])
+
+    trace = None
+    if tracefile is not None:
+        trace = httptrace.Tracer(tracefile)
 
-    mailsender = mailer.Mailer(smtphost, smtpport, smtpauth,
-                               smtpuser, smtppassword, smtpoauthcmd)
+    prof = None
+    if profiledir is not None:
+        import profiling
+        prof = profiling.Profiler()
+        mailsender.add_attachments_hook(prof.attachments)
+        prof.start()
 
     try:
-        dostuff(config, mailsender, payfile, capdfdir, redo)
+        dostuff(config, mailsender, payfile, capdfdir, redo, statedir, trace, verify=verify)
     except KeyboardInterrupt:
         pass
     except urssaf.AlreadyPaidError:
@@ -188,8 +308,15 @@ def main():
 
         msg = "Exception caught while trying to run the declaration.\n\n"
         msg += traceback.format_exc()
-        logs = logging_getHandler("memoryHandler").stream.getvalue().encode()
+        logs = logging_getHandler("memoryHandler").getvalue().encode()
         mailsender.error(smtpuser, msg, attachments=[("debug.log", logs)])
+    finally:
+        if prof is not None:
+            prof.stop()
+            prof.dump(profiledir, "declare")
+        mailsender.close()
+        if trace is not None:
+            trace.close()
 
 
 
@@ -0,0 +1,69 @@
+import logging
+import time
+
+import persist
+
+
+
+# Notification events waiting to be sent together. Each event has a key that
+# identifies what it is about: an event whose key is already pending replaces
+# it, and an event whose key has been sent less than `repeat` seconds ago is
+# dropped. Events describing the current state of something (like the list of
+# overdue invoices) replace all the pending events of the same kind. The state
+# is saved after every change so that no event is lost between two runs.
+class Digest(object):
+    def __init__(self, path, window, repeat):
+        self._path = path
+        self._window = window
+        self._repeat = repeat
+        state = persist.read_json(path, {})
+        self._pending = state.get("pending", [])
+        self._sent = state.get("sent", {})
+        self._last_sent = state.get("last_sent", 0)
+
+    def _save(self):
+        state = {
+            "pending": self._pending,
+            "sent": self._sent,
+            "last_sent": self._last_sent,
+        }
+        persist.write_json(self._path, state)
+
+    @property
+    def pending(self):
+        return list(self._pending)
+
+    def add(self, events, replace=()):
+        now = time.time()
+        self._pending = [e for e in self._pending if e["kind"] not in replace]
+        keys = {e["key"]: i for i, e in enumerate(self._pending)}
+        for e in events:
+            if e["key"] in keys:
+                self._pending[keys[e["key"]]] = e
+            elif now < self._sent.get(e["key"], 0) + self._repeat:
+                logging.debug("Notification %s already sent recently", e["key"])
+            else:
+                keys[e["key"]] = len(self._pending)
+                self._pending.append(e)
+
+        # Forget about the keys that can be sent again anyway
+        self._sent = {k: t for k, t in self._sent.items() if now < t + self._repeat}
+        self._save()
+
+    def due(self):
+        return bool(self._pending) and time.time() >= self._last_sent + self._window
+
+    def flush(self, send, force=False):
+        if not self._pending or not (force or self.due()):
+            return False
+
+        logging.info("Sending digest of %d notifications", len(self._pending))
+        send(self._pending)
+
+        now = time.time()
+        for e in self._pending:
+            self._sent[e["key"]] = now
+        self._pending = []
+        self._last_sent = now
+        self._save()
+        return True
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import argparse
+import configparser
+import locale
+import logging
+import logging.config
+import os
+import sys
+
+import mailer
+
+
+
+SELFPATH = os.path.dirname(os.path.realpath(sys.argv[0]))
+
+
+
+def logging_getHandler(name):
+    for h in logging.getLogger().handlers:
+        if h.name == name:
+            return h
+    return None
+
+
+
+def main():
+    locale.setlocale(locale.LC_ALL, '')
+    logging.config.fileConfig(os.path.join(SELFPATH, "logconf.ini"), disable_existing_loggers=False)
+
+    parser = argparse.ArgumentParser(description="Envoie les mails en attente dans le spool")
+    parser.add_argument("cfgfile", metavar="configfile", help="Fichier de configuration")
+    parser.add_argument("--verbose", "-v", action="count", default=0, help="Augmente le niveau de verbosité")
+    parser.add_argument("--quiet", "-q", action="count", default=0, help="Diminue le niveau de verbosité")
+
+    args = parser.parse_args()
+
+    configpath = args.cfgfile
+    verbose = args.verbose - args.quiet
+
+    loglevels = ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"]
+    ch = logging_getHandler("consoleHandler")
+    curlevel = logging.getLevelName(ch.level)
+    curlevel = loglevels.index(curlevel)
+    verbose = min(len(loglevels) - 1, max(0, curlevel + verbose))
+    ch.setLevel(loglevels[verbose])
+
+    logging.info("Reading config file %s", configpath)
+    config = configparser.ConfigParser()
+    config.read(configpath)
+
+    if config["SMTP"].get("spooldir") is None:
+        logging.error("No spooldir configured in section [SMTP]")
+        sys.exit(1)
+
+    mailsender = mailer.Mailer.from_config(config["SMTP"])
+    try:
+        remaining = mailsender.flush()
+    finally:
+        mailsender.close()
+
+    if remaining > 0:
+        logging.info("%d messages still waiting in the spool", remaining)
+        sys.exit(2)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import datetime
+import json
+import math
+import re
+import urllib.parse
+
+
+
+# Path segments that look like identifiers are replaced to group the requests
+# by endpoint. The query string and fragment are dropped, they may hold secrets.
+ID_SEGMENT = re.compile(r'^(?:\d+|[0-9a-fA-F-]{16,}|[\w-]{32,})$')
+
+
+
+def url_template(url):
+    url = urllib.parse.urlsplit(url)
+    segments = ["{id}" if ID_SEGMENT.match(s) else s for s in url.path.split("/")]
+    return "%s://%s%s" % (url.scheme, url.hostname, "/".join(segments))
+
+
+
+class Tracer(object):
+    def __init__(self, path):
+        self._path = path
+        self._fp = open(path, "a")
+
+    def record(self, step, method, url, status, retries, ttfb, total, size, error=None):
+        entry = {
+            "time": datetime.datetime.now().isoformat(timespec="milliseconds"),
+            "step": step,
+            "method": method.upper(),
+            "url": url_template(url),
+            "status": status,
+            "retries": retries,
+            "ttfb": round(ttfb, 4) if ttfb is not None else None,
+            "total": round(total, 4),
+            "size": size,
+        }
+        if error is not None:
+            entry["error"] = error
+
+        self._fp.write(json.dumps(entry) + "\n")
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+
+def percentile(values, p):
+    values = sorted(values)
+    idx = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[idx]
+
+
+
+def summarize(paths):
+    groups = collections.defaultdict(list)
+    for path in paths:
+        with open(path) as fp:
+            for line in fp:
+                e = json.loads(line)
+                groups[(e["step"], e["method"], e["url"])].append(e)
+
+    lines = []
+    header = "%-10s %-6s %6s %8s %8s %8s %8s %6s  %s"
+    lines.append(header % ("step", "method", "count", "ttfb50", "p50", "p90", "p99", "errors", "url"))
+    for (step, method, url), entries in sorted(groups.items(), key=lambda kv: (str(kv[0][0]), kv[0][1], kv[0][2])):
+        totals = [e["total"] * 1000 for e in entries]
+        ttfbs = [e["ttfb"] * 1000 for e in entries if e["ttfb"] is not None]
+        errors = sum(1 for e in entries if "error" in e or (e["status"] or 0) >= 400)
+        ttfb50 = "%.0f" % percentile(ttfbs, 50) if ttfbs else "-"
+        lines.append("%-10s %-6s %6d %8s %8.0f %8.0f %8.0f %6d  %s" % (
+            step, method, len(entries), ttfb50,
+            percentile(totals, 50), percentile(totals, 90), percentile(totals, 99),
+            errors, url))
+
+    return "\n".join(lines)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Résume les latences des traces HTTP par endpoint (en ms)")
+    parser.add_argument("tracefiles", metavar="tracefile", nargs="+", help="Fichiers de trace produits par --trace")
+    args = parser.parse_args()
+    print(summarize(args.tracefiles))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+import argparse
+import locale
+import logging
+import logging.config
+import os
+import sys
+
+import invoicefile
+
+
+
+SELFPATH = os.path.dirname(os.path.realpath(sys.argv[0]))
+
+
+
+def main():
+    locale.setlocale(locale.LC_ALL, '')
+    logging.config.fileConfig(os.path.join(SELFPATH, "logconf.ini"), disable_existing_loggers=False)
+
+    parser = argparse.ArgumentParser(description="Convertit un répertoire de fichiers .inv en registre de factures")
+    parser.add_argument("invdir", metavar="dir", help="Répertoire contenant les fichiers .inv")
+    parser.add_argument("ledger", metavar="ledger", help="Registre des factures à écrire (.jsonl ou .csv)")
+    args = parser.parse_args()
+
+    invoices = invoicefile.read_invoices(args.invdir)
+    invoicefile.write_ledger(args.ledger, invoices)
+    logging.info("Wrote %d invoices to %s", len(invoices), args.ledger)
+
+
+
+if __name__ == '__main__':
+    main()
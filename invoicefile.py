@@ -0,0 +1,152 @@
+import csv
+import datetime
+import decimal
+import glob
+import json
+import logging
+import os
+import tempfile
+
+
+
+# How late after the deadline a transaction can still pay an invoice
+PAYMENT_DELAY = datetime.timedelta(days=366)
+
+# Same fields as the .inv files, also used as the CSV header
+LEDGER_FIELDS = ["invoicenumber", "invoicedate", "deadline", "amount"]
+
+
+
+class Invoice(object):
+    def __init__(self, invnum, invdate, duedate, amount, source=None):
+        self.invnum = invnum
+        self.invdate = datetime.datetime.strptime(invdate, "%d/%m/%Y").date()
+        self.duedate = datetime.datetime.strptime(duedate, "%d/%m/%Y").date()
+        self.amount = round(decimal.Decimal(amount), 2)
+        self.source = source
+
+    @classmethod
+    def fromfile(cls, filename):
+        keys = LEDGER_FIELDS
+        data = {}
+
+        with open(filename) as fp:
+            for line in fp:
+                line = line.split("#")[0].rstrip()
+                if not line:
+                    logging.debug("Ignoring empty line")
+                    continue
+
+                k, v = line.split(" ", 1)
+                data[k] = v
+
+        missing = set(keys) - set(data)
+        if missing:
+            raise ValueError("Invoice file %s lacks fields %r" % (filename, list(missing)))
+
+        extra = set(data) - set(keys)
+        if extra:
+            logging.warning("Invoice file %s has extra fields %r", filename, list(extra))
+
+        logging.debug("Read invoice %r", data)
+        return cls(*[data[k] for k in keys], source=filename)
+
+    @classmethod
+    def fromdict(cls, data, source=None):
+        missing = set(LEDGER_FIELDS) - set(k for k, v in data.items() if v)
+        if missing:
+            raise ValueError("Invoice %s lacks fields %r" % (source, sorted(missing)))
+        return cls(*[data[k] for k in LEDGER_FIELDS], source=source)
+
+    def todict(self):
+        return {
+            "invoicenumber": self.invnum,
+            "invoicedate": self.invdate.strftime("%d/%m/%Y"),
+            "deadline": self.duedate.strftime("%d/%m/%Y"),
+            "amount": str(self.amount),
+        }
+
+    def __str__(self):
+        d1 = self.invdate.strftime("%d/%m/%Y")
+        d2 = self.duedate.strftime("%d/%m/%Y")
+        return 'Invoice("%s", %s, %s, %s)' % (self.invnum, d1, d2, self.amount)
+
+    def __repr__(self):
+        return "<" + str(self) + ">"
+
+
+
+def ledger_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".jsonl", ".json"):
+        return "jsonl"
+    if ext == ".csv":
+        return "csv"
+    raise ValueError("Unknown invoice ledger format for %s, must be .jsonl or .csv" % path)
+
+
+
+def _ledger_rows(fp, fmt):
+    if fmt == "jsonl":
+        for lineno, line in enumerate(fp, 1):
+            if line.strip():
+                yield lineno, line
+    else:
+        reader = csv.DictReader(fp)
+        missing = set(LEDGER_FIELDS) - set(reader.fieldnames or [])
+        if missing:
+            raise ValueError("CSV invoice ledger lacks columns %r" % sorted(missing))
+        for row in reader:
+            yield reader.line_num, row
+
+
+
+def iter_ledger(path, errors=None):
+    fmt = ledger_format(path)
+    with open(path, newline="") as fp:
+        for lineno, row in _ledger_rows(fp, fmt):
+            source = "%s:%d" % (path, lineno)
+            try:
+                if fmt == "jsonl":
+                    row = json.loads(row)
+                    row = {k: str(v) for k, v in row.items()}
+                yield Invoice.fromdict(row, source)
+            except (ValueError, decimal.InvalidOperation) as e:
+                if errors is None:
+                    raise ValueError("%s: %s" % (source, e))
+                errors.append((lineno, str(e)))
+
+
+
+def write_ledger(path, invoices):
+    fmt = ledger_format(path)
+    dirname = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", newline="") as fp:
+            if fmt == "jsonl":
+                for inv in invoices:
+                    fp.write(json.dumps(inv.todict()) + "\n")
+            else:
+                writer = csv.DictWriter(fp, LEDGER_FIELDS)
+                writer.writeheader()
+                for inv in invoices:
+                    writer.writerow(inv.todict())
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+
+def read_invoices(invdir):
+    invlist = []
+    if os.path.isfile(invdir):
+        # Consolidated ledger instead of a directory of .inv files
+        invlist.extend(iter_ledger(invdir))
+    else:
+        for f in glob.iglob(invdir + "/*.inv"):
+            invlist.append(Invoice.fromfile(f))
+
+    invlist.sort(key=lambda inv: inv.invnum)
+    return invlist
@@ -0,0 +1,59 @@
+import datetime
+import json
+import logging
+import os
+
+
+
+# Append-only log of the declaration steps of a period, one JSON object per
+# line. Each record is synced to disk before the next step starts so that a
+# rerun knows what has already been done without asking the server.
+class Journal(object):
+    def __init__(self, path):
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path
+
+    def record(self, step, **data):
+        entry = {"time": datetime.datetime.now().isoformat(timespec="seconds"), "step": step}
+        entry.update(data)
+        line = json.dumps(entry, sort_keys=True) + "\n"
+
+        os.makedirs(os.path.dirname(self._path) or ".", mode=0o700, exist_ok=True)
+        fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        with os.fdopen(fd, "w") as fp:
+            fp.write(line)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def entries(self):
+        try:
+            fp = open(self._path)
+        except FileNotFoundError:
+            return []
+
+        entries = []
+        with fp:
+            for lineno, line in enumerate(fp, 1):
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Most likely a record torn by a crash
+                    logging.warning("%s:%d: Ignoring invalid journal record", self._path, lineno)
+        return entries
+
+    def last(self):
+        entries = self.entries()
+        if not entries:
+            return None
+        return entries[-1]
+
+    def paid(self, amount):
+        # Any step recorded after the payment means the declaration was
+        # started again, the payment doesn't hold anymore
+        entry = self.last()
+        if entry is None or entry["step"] != "paid" or entry["amount"] != amount:
+            return None
+        return entry
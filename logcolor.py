@@ -1,24 +1,32 @@
 import logging
-import colorama
 
 
 
 class ColorLogFormatter(logging.Formatter):
-    namecolors = {
-        'DEBUG': colorama.Fore.BLUE,
-        'INFO': colorama.Fore.GREEN,
-        'WARNING': colorama.Fore.YELLOW,
-        'ERROR': colorama.Style.DIM + colorama.Fore.RED,
-        'CRITICAL': colorama.Fore.RED
-    }
-
     def __init__(self, *args, **kwargs):
         super(ColorLogFormatter, self).__init__(*args, **kwargs)
+        self._colorama = None
+        self.namecolors = {}
+
+    def _init_colorama(self):
+        # colorama is only loaded once something is actually logged
+        import colorama
         colorama.init()
+        self._colorama = colorama
+        self.namecolors = {
+            'DEBUG': colorama.Fore.BLUE,
+            'INFO': colorama.Fore.GREEN,
+            'WARNING': colorama.Fore.YELLOW,
+            'ERROR': colorama.Style.DIM + colorama.Fore.RED,
+            'CRITICAL': colorama.Fore.RED
+        }
 
     def colorname(self, name):
+        if self._colorama is None:
+            self._init_colorama()
+        style = self._colorama.Style
         s = self.namecolors.get(name, "")
-        return colorama.Style.BRIGHT + s + name + colorama.Style.RESET_ALL
+        return style.BRIGHT + s + name + style.RESET_ALL
 
     def format(self, record):
         record.levelnamecolor = self.colorname(record.levelname)
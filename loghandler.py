@@ -0,0 +1,90 @@
+import collections
+import logging
+import tempfile
+import zlib
+
+
+
+class RingBufferHandler(logging.Handler):
+    # Records are kept unformatted until the log is actually needed. When the
+    # buffer holds more than capacity records or roughly maxbytes of messages,
+    # the oldest half is formatted and compressed into a temporary file.
+    def __init__(self, capacity=10000, maxbytes=4 * 1024 * 1024, level=logging.NOTSET):
+        super(RingBufferHandler, self).__init__(level)
+        self.capacity = capacity
+        self.maxbytes = maxbytes
+        self._records = collections.deque()
+        self._sizes = collections.deque()
+        self._size = 0
+        self._spill = None
+        self._compressor = None
+
+    @staticmethod
+    def _estimate_size(record):
+        size = len(str(record.msg))
+        args = record.args if isinstance(record.args, tuple) else (record.args,)
+        for a in args:
+            size += len(a) if isinstance(a, (str, bytes)) else 64
+        return size
+
+    def emit(self, record):
+        size = self._estimate_size(record)
+        self._records.append(record)
+        self._sizes.append(size)
+        self._size += size
+
+        if len(self._records) > self.capacity or self._size > self.maxbytes:
+            self._spill_oldest(len(self._records) // 2 or 1)
+
+    def _format_all(self, records):
+        lines = []
+        for r in records:
+            try:
+                lines.append(self.format(r) + "\n")
+            except Exception:
+                self.handleError(r)
+        return "".join(lines)
+
+    def _spill_oldest(self, count):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(prefix="urssaf-log-")
+            self._compressor = zlib.compressobj(wbits=31)
+
+        records = []
+        for _ in range(count):
+            records.append(self._records.popleft())
+            self._size -= self._sizes.popleft()
+
+        data = self._format_all(records).encode()
+        self._spill.write(self._compressor.compress(data))
+
+    def getvalue(self):
+        self.acquire()
+        try:
+            spilled = ""
+            if self._spill is not None:
+                self._spill.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+                self._spill.seek(0)
+                decompressor = zlib.decompressobj(wbits=31)
+                spilled = decompressor.decompress(self._spill.read()).decode()
+                self._spill.seek(0, 2)
+
+            return spilled + self._format_all(self._records)
+        finally:
+            self.release()
+
+    def clear(self):
+        self.acquire()
+        try:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+            self._records.clear()
+            self._sizes.clear()
+            self._size = 0
+        finally:
+            self.release()
+
+    def close(self):
+        self.clear()
+        super(RingBufferHandler, self).close()
@@ -1,14 +1,24 @@
-import email.message
-import email.policy
+import json
 import logging
-import mimetypes
-import smtplib
+import os
 import subprocess
+import threading
+import time
+
+import spool
+
+
+
+# The email and smtplib modules are imported lazily as they take tens of
+# milliseconds to load and most runs don't send any mail
+def mail_policy():
+    import email.policy
+    return email.policy.EmailPolicy(raise_on_defect=True, linesep="\r\n", utf8=True)
 
 
 
 class Mailer(object):
-    def __init__(self, host, port=None, authmethod=None, user=None, pwd=None, oauthcmd=None):
+    def __init__(self, host, port=None, authmethod=None, user=None, pwd=None, oauthcmd=None, tokenttl=3000, ssl=True, spooldir=None, timeout=30, spoolwait=5):
         if authmethod is None:
             if pwd and oauthcmd:
                 raise ValueError("SMTP password and oauthcmd provided")
@@ -23,29 +33,218 @@ class Mailer(object):
         self._auth = authmethod
         self._user = user
         self._pass = pwd
-        self._oauthcmd = oauthcmd.lower()
+        self._oauthcmd = oauthcmd
+        self._tokenttl = tokenttl
+        self._token = None
+        self._token_expiry = None
+        self._smtp = None
+        self._ssl = ssl
+        self._timeout = timeout
 
+        self._attachment_hooks = []
 
+        self._spool = None
+        self._worker = None
+        self._wakeup = threading.Event()
+        self._closing = False
+        self._spoolwait = spoolwait
+        if spooldir is not None:
+            self._spool = spool.MailSpool(spooldir)
 
 
-    def _oauthcb(self, x=None):
-        if x is not None:
-            return ""
+
+    @classmethod
+    def from_config(cls, cfg):
+        smtphost = cfg["smtphost"]
+        smtpport = cfg.get("smtpport")
+        smtpauth = cfg.get("smtpauthmethod")
+        smtpuser = cfg.get("smtpuser")
+        smtppassword = cfg.get("smtppwd")
+        smtpoauthcmd = cfg.get("smtpoauthtokencmd")
+        smtptokenttl = cfg.getint("smtpoauthtokenttl", 3000)
+        smtpssl = cfg.getboolean("smtpssl", True)
+        spooldir = cfg.get("spooldir")
+        if spooldir is not None:
+            spooldir = os.path.expanduser(spooldir)
+        smtptimeout = cfg.getfloat("smtptimeout", 30)
+        spoolwait = cfg.getfloat("spoolwait", 5)
+
+        return cls(smtphost, smtpport, smtpauth, smtpuser, smtppassword,
+                   smtpoauthcmd, smtptokenttl, smtpssl, spooldir,
+                   smtptimeout, spoolwait)
+
+
+
+    def _oauth_token(self):
+        if self._token is not None and time.monotonic() < self._token_expiry:
+            logging.debug("Reusing cached OAuth token")
+            return self._token
+
         logging.debug("Running OAuth token generation command: %s", self._oauthcmd)
+        start = time.monotonic()
         token = subprocess.check_output(self._oauthcmd, shell=True)
         token = token.decode().strip()
+        ttl = self._tokenttl
+
+        # The command may output the whole JSON token response
+        if token.startswith("{"):
+            res = json.loads(token)
+            token = res["access_token"]
+            ttl = int(res.get("expires_in", ttl))
+
         logging.debug("Got token: %s", token)
-        auth_string = "user=%s\1auth=Bearer %s\1\1" % (self._user, token)
+        self._token = token
+        # Keep a margin to not send a token that expires during the session
+        self._token_expiry = start + ttl * 0.9
+        return token
+
+
+
+    def _oauthcb(self, x=None):
+        if x is not None:
+            return ""
+        auth_string = "user=%s\1auth=Bearer %s\1\1" % (self._user, self._oauth_token())
         return auth_string
 
 
 
+    def _connect(self):
+        import smtplib
+
+        logging.debug("Connecting to SMTP server %s:%r", self._host, self._port)
+        if self._ssl:
+            smtp = smtplib.SMTP_SSL(self._host, port=self._port, timeout=self._timeout)
+        else:
+            smtp = smtplib.SMTP(self._host, port=self._port, timeout=self._timeout)
+
+        try:
+            if not self._auth:
+                logging.info("No SMTP authentication method provided")
+            elif self._auth == "login":
+                logging.debug("Login to SMTP server with username: %s", self._user)
+                smtp.login(self._user, self._pass)
+            elif self._auth == "oauth":
+                logging.debug("OAuth to SMTP server with username: %s", self._user)
+                smtp.ehlo_or_helo_if_needed()
+                try:
+                    smtp.auth("XOAUTH2", self._oauthcb)
+                except smtplib.SMTPAuthenticationError:
+                    if self._token is None:
+                        raise
+                    logging.info("Cached OAuth token rejected, getting a new one")
+                    self._token = None
+                    smtp.auth("XOAUTH2", self._oauthcb)
+            else:
+                raise ValueError("Unknown SMTP authentication method " + self._auth)
+        except:
+            smtp.close()
+            raise
+
+        return smtp
+
+
+
+    def _send(self, mail):
+        import smtplib
+
+        if self._smtp is None:
+            self._smtp = self._connect()
+
+        try:
+            self._smtp.send_message(mail)
+            return
+        except smtplib.SMTPServerDisconnected:
+            logging.info("SMTP connection lost, reconnecting")
+        except smtplib.SMTPResponseException as e:
+            # 421 is how servers close idle connections
+            if e.smtp_code != 421:
+                raise
+            logging.info("SMTP server closed the connection (%s), reconnecting", e.smtp_error)
+
+        self._smtp.close()
+        self._smtp = self._connect()
+        self._smtp.send_message(mail)
+
+
+
+    def add_attachments_hook(self, hook):
+        # The hook returns a list of (name, content) added to every message
+        self._attachment_hooks.append(hook)
+
+
+
+    def _send_bytes(self, data):
+        import email
+
+        self._send(email.message_from_bytes(data, policy=mail_policy()))
+
+
+
+    def _deliver(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                self._spool.flush(self._send_bytes)
+            except Exception:
+                logging.exception("Spooled mail delivery failed:")
+
+            if self._closing and not self._wakeup.is_set():
+                break
+
+
+
+    def flush(self):
+        if self._spool is None:
+            return 0
+        return self._spool.flush(self._send_bytes)
+
+
+
+    def close(self, timeout=None):
+        # Only wait a little for the worker, the mails it couldn't send are
+        # still in the spool for flushmail.py
+        if timeout is None:
+            timeout = self._spoolwait
+
+        if self._worker is not None:
+            logging.debug("Waiting up to %ss for the delivery of spooled mails", timeout)
+            self._closing = True
+            self._wakeup.set()
+            self._worker.join(timeout)
+            if self._worker.is_alive():
+                logging.warning("Spooled mails not delivered yet, they will be sent by flushmail.py")
+                # The daemon thread still uses the connection
+                self._worker = None
+                return
+            self._worker = None
+
+        if self._smtp is None:
+            return
+
+        import smtplib
+
+        logging.debug("Closing SMTP connection")
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self._smtp.close()
+        self._smtp = None
+
+
+
     def message(self, to, subj, msg, attachments=None):
+        import email.message
+        import mimetypes
+
         if attachments is None:
             attachments = []
 
-        policy = email.policy.EmailPolicy(raise_on_defect=True, linesep="\r\n", utf8=True)
-        mail = email.message.EmailMessage(policy=policy)
+        attachments = list(attachments)
+        for hook in self._attachment_hooks:
+            attachments.extend(hook())
+
+        mail = email.message.EmailMessage(policy=mail_policy())
         mail['Subject'] = "[BOT URSSAF] %s" % subj
         mail['From'] = "Bot Communiste <%s>" % self._user
         mail['To'] = "Entrepreneur <%s>" % to
@@ -59,24 +258,16 @@ class Mailer(object):
             maintype, subtype = mime.split("/")
             mail.add_attachment(content, maintype=maintype, subtype=subtype, filename=name)
 
-        logging.debug("Connecting to SMTP server %s:%r", self._host, self._port)
-        smtp = smtplib.SMTP_SSL(self._host, port=self._port)
-
-        if not self._auth:
-            logging.info("No SMTP authentication method provided")
-        elif self._auth == "login":
-            logging.debug("Login to SMTP server with username: %s", self._user)
-            smtp.login(self._user, self._pass)
-        elif self._auth == "oauth":
-            logging.debug("OAuth to SMTP server with username: %s", self._user)
-            smtp.ehlo_or_helo_if_needed()
-            smtp.auth("XOAUTH2", self._oauthcb)
-        else:
-            raise ValueError("Unknown SMTP authentication method " + self._auth)
+        if self._spool is not None:
+            self._spool.put(mail.as_bytes())
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._deliver, name="maildelivery", daemon=True)
+                self._worker.start()
+            self._wakeup.set()
+            return
 
         logging.debug("Sending message of %d bytes", len(mail.as_bytes()))
-        smtp.send_message(mail)
-        smtp.quit()
+        self._send(mail)
 
 
 
@@ -1,18 +1,25 @@
+import collections
 import datetime
 import decimal
 import logging
+import math
+import os
 import re
+import shutil
+
+import persist
 
 
 
 class Payment(object):
     rparse = re.compile(r'^(\S+)\s+(\S+)\s+(\S+)\s+(.*)')
 
-    def __init__(self, date, invnum, amount, label):
+    def __init__(self, date, invnum, amount, label, lineno=None):
         self.date = date
         self.invnum = invnum
         self.amount = round(amount, 2)
         self.label = label.rstrip()
+        self.lineno = lineno
 
     @classmethod
     def from_string(cls, string):
@@ -34,6 +41,140 @@ class Payment(object):
 
 
 
+# Minimum similarity between the label of a recorded payment and the label of
+# a transaction for them to be the same transfer
+LABEL_SIMILARITY = 0.8
+
+# Number of the most recent recorded labels used to weight the trigrams
+WEIGHT_SAMPLE = 500
+
+
+
+def label_ngrams(label, n=3):
+    norm = " ".join(re.sub(r'\W+', " ", label.upper()).split())
+    if len(norm) <= n:
+        return {norm}
+    return {norm[i:i + n] for i in range(len(norm) - n + 1)}
+
+
+
+# Index of the transactions already recorded in the paymentfile. Banks may edit
+# the labels afterward, so the transactions are bucketed by date and amount and
+# the labels are compared on their trigrams.
+#
+# Banks truncate or extend the labels, so the similarity is the containment of
+# the shorter label in the other one rather than a Jaccard index. The trigrams
+# are weighted by their rarity among the recorded labels: the bank boilerplate
+# ("VIR SEPA RECU /DE ... /MOTIF ...") found in most labels barely counts, the
+# payer name and the reference do. The weights are only computed once a
+# transaction doesn't match exactly, from the most recent labels.
+class TransactionIndex(object):
+    def __init__(self, payments=(), threshold=LABEL_SIMILARITY):
+        self.threshold = threshold
+        self._buckets = collections.defaultdict(list)
+        self._payments = []
+        self._ngrams = {}
+        self._nlabels = 0
+        self._df = None
+        for p in payments:
+            self.add(p)
+
+    def add(self, p):
+        self._buckets[(p.date, p.amount)].append(p)
+        self._payments.append(p)
+        self._df = None
+
+    def _weight(self, gram):
+        return math.log(1 + self._nlabels / max(self._df[gram], 1))
+
+    def _compute_weights(self):
+        if self._df is not None:
+            return
+
+        sample = self._payments[-WEIGHT_SAMPLE:]
+        self._nlabels = len(sample)
+        self._df = collections.Counter()
+        for p in sample:
+            self._df.update(self._payment_ngrams(p))
+
+    def _payment_ngrams(self, p):
+        grams = self._ngrams.get(id(p))
+        if grams is None:
+            grams = self._ngrams[id(p)] = label_ngrams(p.label)
+        return grams
+
+    def _similarity(self, grams1, grams2):
+        w1 = sum(self._weight(g) for g in grams1)
+        w2 = sum(self._weight(g) for g in grams2)
+        common = sum(self._weight(g) for g in grams1 & grams2)
+
+        # A label shorter than half the other one isn't considered contained
+        # in it, it's more likely some boilerplate than a truncated label
+        return common / max(min(w1, w2), max(w1, w2) / 2)
+
+    def pop_exact(self, date, amount, label):
+        bucket = self._buckets.get((date, amount))
+        if not bucket:
+            return None
+
+        label = label.rstrip()
+        for idx, p in enumerate(bucket):
+            if p.label == label:
+                del bucket[idx]
+                return p
+        return None
+
+    def pop_similar(self, trans):
+        # Match the transactions with the recorded payments of similar labels
+        # and return the transactions left. In each bucket, the most similar
+        # pairs are matched first, so that a transaction from another payer
+        # can't take a payment just by coming first.
+        groups = collections.defaultdict(list)
+        for idx, t in enumerate(trans):
+            if self._buckets.get((t.date, t.amount)):
+                groups[(t.date, t.amount)].append(idx)
+
+        if groups:
+            self._compute_weights()
+
+        matched = set()
+        for key, idxs in groups.items():
+            bucket = self._buckets[key]
+            pairs = []
+            for idx in idxs:
+                grams = label_ngrams(trans[idx].label)
+                for pidx, p in enumerate(bucket):
+                    sim = self._similarity(grams, self._payment_ngrams(p))
+                    if sim >= self.threshold:
+                        pairs.append((sim, idx, pidx))
+
+            popped = set()
+            for sim, idx, pidx in sorted(pairs, key=lambda x: x[0], reverse=True):
+                if idx in matched or pidx in popped:
+                    continue
+
+                matched.add(idx)
+                popped.add(pidx)
+                logging.info("Transaction label changed from %r to %r (similarity %.2f)",
+                             bucket[pidx].label, trans[idx].label.rstrip(), sim)
+
+            self._buckets[key] = [p for pidx, p in enumerate(bucket) if pidx not in popped]
+
+        return [t for idx, t in enumerate(trans) if idx not in matched]
+
+
+
+def parse_line(line, lineno=None):
+    line = line.split("#", 1)[0].rstrip()
+    if not line:
+        return None
+
+    p = Payment.from_string(line)
+    p.lineno = lineno
+    return p
+
+
+
 class PaymentFile(object):
     def __init__(self, path=None):
         self._path = path
@@ -44,6 +185,10 @@ class PaymentFile(object):
         else:
             self._read()
 
+    @property
+    def path(self):
+        return self._path
+
     def _read(self):
         try:
             fp = open(self._path)
@@ -52,14 +197,13 @@ class PaymentFile(object):
             return
 
         with fp:
-            for l in fp:
+            for lineno, l in enumerate(fp, 1):
                 logging.debug("Reading paymentfile line: %r", l)
-                l = l.split("#", 1)[0].rstrip()
-                if not l:
+                p = parse_line(l, lineno)
+                if p is None:
                     logging.debug("Ignoring empty line")
                     continue
 
-                p = Payment.from_string(l)
                 logging.debug("Read payment: %s", p)
                 self._payments.append(p)
 
@@ -80,16 +224,19 @@ class PaymentFile(object):
 
         return list(invoicesdict.values())
 
-    def filter_transactions(self, trans):
-        pt = set((p.date, p.amount, p.label) for p in self._payments)
-        res = []
+    def filter_transactions(self, trans, threshold=LABEL_SIMILARITY):
+        # Each recorded payment can only account for one transaction. Exact
+        # labels are matched first so that a renamed transaction doesn't steal
+        # the payment of an unchanged one.
+        index = TransactionIndex(self._payments, threshold)
+        unknown = []
         for t in trans:
-            if (t.date, t.amount, t.label.rstrip()) not in pt:
-                res.append(t)
+            if index.pop_exact(t.date, t.amount, t.label) is None:
+                unknown.append(t)
             else:
                 logging.debug("Filtering out transaction already matched: %s", t)
 
-        return res
+        return index.pop_similar(unknown)
 
     def add_payment(self, inv, t):
         p = Payment.from_invoice_transaction(inv, t)
@@ -103,5 +250,30 @@ class PaymentFile(object):
             logging.info("Adding to file %r payment %s", self._path, p)
             print(p, file=fp)
 
+    def rewrite(self, payments):
+        # Replace the whole file at once, the previous one is kept as .bak
+        self._payments = sorted(payments, key=lambda p: p.date)
+        if self._path is None:
+            logging.debug("No file to write payments")
+            return
+
+        if os.path.exists(self._path):
+            logging.info("Saving previous payment file as %r", self._path + ".bak")
+            shutil.copy2(self._path, self._path + ".bak")
+
+        logging.info("Writing %d payments to %r", len(self._payments), self._path)
+        data = "".join("%s\n" % p for p in self._payments)
+        persist.atomic_write(self._path, data.encode("utf-8"))
+
     def payments_in_range(self, begin, end):
         return [p for p in self._payments if p.date >= begin and p.date < end]
+
+    def monthly_totals(self, begin=None, end=None):
+        # Totals per month, keyed by the first day of the month
+        totals = collections.defaultdict(decimal.Decimal)
+        for p in self._payments:
+            if (begin is not None and p.date < begin) or (end is not None and p.date >= end):
+                continue
+            totals[p.date.replace(day=1)] += p.amount
+
+        return dict(totals)
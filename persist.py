@@ -0,0 +1,40 @@
+import json
+import os
+import tempfile
+
+
+
+def default_dir():
+    base = os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+    return os.path.join(base, "urssaf-declare")
+
+
+
+def atomic_write(path, data):
+    dirname = os.path.dirname(path) or "."
+    os.makedirs(dirname, mode=0o700, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+
+def read_json(path, default=None):
+    try:
+        with open(path, "rb") as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return default
+
+
+
+def write_json(path, obj):
+    atomic_write(path, json.dumps(obj, indent=4).encode("utf-8"))
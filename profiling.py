@@ -0,0 +1,89 @@
+import cProfile
+import datetime
+import io
+import logging
+import marshal
+import os
+import pstats
+import tracemalloc
+
+
+
+class Profiler(object):
+    def __init__(self, top=30, frames=10):
+        self._profile = cProfile.Profile()
+        self._top = top
+        self._frames = frames
+        self._running = False
+        self._snapshot = None
+
+    def start(self):
+        tracemalloc.start(self._frames)
+        self._profile.enable()
+        self._running = True
+
+    def stop(self):
+        if not self._running:
+            return
+        self._profile.disable()
+        self._snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        self._running = False
+
+    def _stats(self):
+        # Building the stats disables the profiler
+        stats = pstats.Stats(self._profile)
+        if self._running:
+            self._profile.enable()
+        return stats
+
+    def _take_snapshot(self):
+        if self._running:
+            return tracemalloc.take_snapshot()
+        return self._snapshot
+
+    def pstats_dump(self):
+        return marshal.dumps(self._stats().stats)
+
+    def profile_summary(self):
+        out = io.StringIO()
+        stats = self._stats()
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(self._top)
+        return out.getvalue()
+
+    def allocation_summary(self):
+        snapshot = self._take_snapshot()
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+
+        lines = []
+        if self._running:
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append("Current: %.1f KiB, peak: %.1f KiB" % (current / 1024, peak / 1024))
+
+        stats = snapshot.statistics("lineno")
+        lines.append("Top %d allocations by line:" % self._top)
+        for s in stats[:self._top]:
+            lines.append("%s" % s)
+
+        total = sum(s.size for s in stats)
+        lines.append("Total allocated size: %.1f KiB" % (total / 1024))
+        return "\n".join(lines) + "\n"
+
+    def attachments(self):
+        return [
+            ("profile.pstats", self.pstats_dump()),
+            ("profile.txt", self.profile_summary().encode()),
+            ("allocations.txt", self.allocation_summary().encode()),
+        ]
+
+    def dump(self, outdir, prefix):
+        os.makedirs(outdir, exist_ok=True)
+        base = os.path.join(outdir, "%s-%s" % (prefix, datetime.datetime.now().strftime("%Y%m%d-%H%M%S")))
+        logging.info("Writing profile to %s.pstats and %s.alloc.txt", base, base)
+        self._stats().dump_stats(base + ".pstats")
+        with open(base + ".alloc.txt", "w") as fp:
+            fp.write(self.allocation_summary())
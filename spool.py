@@ -0,0 +1,99 @@
+import fcntl
+import logging
+import os
+import socket
+import time
+
+
+
+RETRY_DELAY = 60
+RETRY_MAX_DELAY = 6 * 3600
+MAX_ATTEMPTS = 30
+
+
+
+# Maildir-like spool: messages are written in tmp/ and atomically moved to new/
+# once complete. Failed deliveries are renamed to <name>:<attempts>,<notbefore>
+# and messages that can't be delivered after MAX_ATTEMPTS end up in failed/.
+class MailSpool(object):
+    def __init__(self, root):
+        self._root = root
+        self._tmp = os.path.join(root, "tmp")
+        self._new = os.path.join(root, "new")
+        self._failed = os.path.join(root, "failed")
+        self._seq = 0
+
+        for d in (self._tmp, self._new, self._failed):
+            os.makedirs(d, mode=0o700, exist_ok=True)
+
+    def _uniquename(self):
+        self._seq += 1
+        return "%.6f.P%dQ%d.%s" % (time.time(), os.getpid(), self._seq, socket.gethostname())
+
+    def put(self, data):
+        name = self._uniquename()
+        tmppath = os.path.join(self._tmp, name)
+        with open(tmppath, "xb") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        os.rename(tmppath, os.path.join(self._new, name))
+        logging.debug("Spooled message %s of %d bytes", name, len(data))
+        return name
+
+    def pending(self):
+        res = []
+        for f in os.listdir(self._new):
+            name, _, info = f.partition(":")
+            attempts, notbefore = 0, 0.0
+            if info:
+                attempts, notbefore = info.split(",")
+                attempts, notbefore = int(attempts), float(notbefore)
+            res.append((f, attempts, notbefore))
+
+        res.sort()
+        return res
+
+    def flush(self, send):
+        with open(os.path.join(self._root, "lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            return self._flush(send)
+
+    def _flush(self, send):
+        now = time.time()
+        remaining = 0
+        for f, attempts, notbefore in self.pending():
+            path = os.path.join(self._new, f)
+            if notbefore > now:
+                logging.debug("Message %s not due before %s", f, time.ctime(notbefore))
+                remaining += 1
+                continue
+
+            try:
+                with open(path, "rb") as fp:
+                    data = fp.read()
+            except FileNotFoundError:
+                continue
+
+            try:
+                send(data)
+            except Exception as e:
+                attempts += 1
+                name = f.partition(":")[0]
+                if attempts >= MAX_ATTEMPTS:
+                    logging.error("Giving up delivering message %s after %d attempts: %s", name, attempts, e)
+                    os.rename(path, os.path.join(self._failed, name))
+                    continue
+
+                delay = min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** (attempts - 1))
+                logging.warning("Delivery of message %s failed (attempt %d), retrying in %ds: %s", name, attempts, delay, e)
+                newname = "%s:%d,%d" % (name, attempts, now + delay)
+                os.rename(path, os.path.join(self._new, newname))
+                remaining += 1
+                continue
+
+            logging.debug("Delivered spooled message %s", f)
+            os.unlink(path)
+
+        return remaining
@@ -0,0 +1,181 @@
+import csv
+import datetime
+import decimal
+import html
+import os
+import re
+
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+
+# Same attributes as the woob transactions used by checkpayments
+class Transaction(object):
+    def __init__(self, date, amount, label):
+        self.date = date
+        self.amount = amount
+        self.label = label
+
+    def __str__(self):
+        return "%s %s %s" % (self.date, self.amount, self.label)
+
+    def __repr__(self):
+        return "<Transaction %s>" % self
+
+
+
+def statement_format(path, cfg=None):
+    fmt = cfg.get("format") if cfg is not None else None
+    if fmt:
+        return fmt.lower()
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".ofx", ".qfx"):
+        return "ofx"
+    if ext == ".csv":
+        return "csv"
+    raise ValueError("Unknown bank statement format for %s, must be .ofx, .qfx or .csv" % path)
+
+
+
+def parse_amount(s, decimalsep="."):
+    s = s.replace(" ", "").replace("\xa0", "").replace("\u202f", "")
+    if decimalsep != ".":
+        s = s.replace(".", "").replace(decimalsep, ".")
+    return decimal.Decimal(s)
+
+
+
+def ofx_encoding(head):
+    # OFX 1.x has an SGML header, OFX 2.x an XML declaration
+    m = re.search(rb'encoding="([\w-]+)"', head)
+    if m is not None:
+        return m.group(1).decode()
+
+    m = re.search(rb'CHARSET:\s*([\w-]+)', head)
+    if m is not None:
+        charset = m.group(1).decode().upper()
+        if charset == "1252":
+            return "cp1252"
+        if charset in ("ISO-8859-1", "8859-1", "NONE"):
+            return "latin-1"
+        if charset == "UTF-8":
+            return "utf-8"
+
+    return "utf-8"
+
+
+
+def ofx_tags(fp):
+    # Tags of OFX 1.x don't need to be closed, so it can't be parsed as XML.
+    # Yield the (tag, text) pairs while reading the file chunk by chunk.
+    rest = ""
+    while True:
+        chunk = fp.read(CHUNK_SIZE)
+        if not chunk:
+            break
+
+        parts = (rest + chunk).split("<")
+        rest = parts.pop()
+        for p in parts:
+            tag, sep, text = p.partition(">")
+            if sep:
+                yield tag.strip().upper(), html.unescape(text.strip())
+
+    tag, sep, text = rest.partition(">")
+    if sep:
+        yield tag.strip().upper(), html.unescape(text.strip())
+
+
+
+def ofx_transaction(path, trn):
+    try:
+        date = datetime.datetime.strptime(trn["DTPOSTED"][:8], "%Y%m%d").date()
+        amount = parse_amount(trn["TRNAMT"], "," if "," in trn["TRNAMT"] else ".")
+    except (KeyError, ValueError, decimal.InvalidOperation) as e:
+        raise ValueError("%s: Invalid transaction %r: %s" % (path, trn, e))
+
+    label = " ".join(trn[k] for k in ("NAME", "MEMO") if trn.get(k))
+    return Transaction(date, amount, label)
+
+
+
+def iter_ofx(path, encoding=None):
+    if encoding is None:
+        with open(path, "rb") as fp:
+            encoding = ofx_encoding(fp.read(1024))
+
+    with open(path, encoding=encoding, errors="replace") as fp:
+        trn = None
+        for tag, text in ofx_tags(fp):
+            # Some exporters don't close the transactions either
+            if tag in ("STMTTRN", "/STMTTRN", "/BANKTRANLIST") and trn is not None:
+                yield ofx_transaction(path, trn)
+                trn = None
+
+            if tag == "STMTTRN":
+                trn = {}
+            elif trn is not None and not tag.startswith("/"):
+                trn[tag] = text
+
+
+
+def iter_csv(path, cfg=None):
+    if cfg is None:
+        cfg = {}
+
+    delimiter = cfg.get("delimiter", ";")
+    datecol = cfg.get("date", "Date")
+    dateformat = cfg.get("dateformat", "%d/%m/%Y")
+    labelcol = cfg.get("label", "Libellé")
+    amountcol = cfg.get("amount", "Montant")
+    creditcol = cfg.get("credit")
+    debitcol = cfg.get("debit")
+    decimalsep = cfg.get("decimal", ",")
+    skiplines = int(cfg.get("skiplines", 0))
+
+    with open(path, encoding=cfg.get("encoding", "utf-8-sig"), newline="") as fp:
+        # Some banks put the account details before the header
+        for _ in range(skiplines):
+            fp.readline()
+
+        reader = csv.DictReader(fp, delimiter=delimiter)
+        for row in reader:
+            if not row.get(datecol):
+                continue
+
+            try:
+                date = datetime.datetime.strptime(row[datecol].strip(), dateformat).date()
+                if creditcol is not None:
+                    credit = row[creditcol].strip()
+                    debit = row[debitcol].strip() if debitcol is not None else ""
+                    if credit:
+                        amount = parse_amount(credit, decimalsep)
+                    else:
+                        amount = -abs(parse_amount(debit or "0", decimalsep))
+                else:
+                    amount = parse_amount(row[amountcol], decimalsep)
+                label = row[labelcol].strip()
+            except (KeyError, ValueError, decimal.InvalidOperation) as e:
+                raise ValueError("%s:%d: %s" % (path, reader.line_num + skiplines, e))
+
+            yield Transaction(date, amount, label)
+
+
+
+def iter_statement(path, cfg=None, since=None):
+    fmt = statement_format(path, cfg)
+    if fmt == "ofx":
+        encoding = cfg.get("encoding") if cfg is not None else None
+        trans = iter_ofx(path, encoding)
+    elif fmt == "csv":
+        trans = iter_csv(path, cfg)
+    else:
+        raise ValueError("Unknown bank statement format %r" % fmt)
+
+    # Unlike the bank website, the exports are not always sorted by date
+    for t in trans:
+        if since is None or t.date >= since:
+            yield t
@@ -0,0 +1,50 @@
+import datetime
+import decimal
+import os
+import tempfile
+import unittest
+
+import paymentfile
+import statements
+
+
+
+DATE = datetime.date(2024, 3, 1)
+AMOUNT = decimal.Decimal("100")
+LABEL = "VIR SEPA RECU /DE M JEAN DUPONT /MOTIF FACTURE 2024-012"
+OTHER = "VIR SEPA RECU /DE MME MARIE CURIE /MOTIF FACTURE 2024-013"
+
+
+
+class FilterTransactionsTest(unittest.TestCase):
+    def setUp(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "paymentfile.txt")
+            with open(path, "w") as fp:
+                fp.write("%s F12 %s %s\n" % (DATE, AMOUNT, LABEL))
+            self.payments = paymentfile.PaymentFile(path)
+
+    def filter(self, *labels):
+        trans = [statements.Transaction(DATE, AMOUNT, label) for label in labels]
+        return [t.label for t in self.payments.filter_transactions(trans)]
+
+    def test_truncated(self):
+        self.assertEqual(self.filter(LABEL[:47]), [])
+
+    def test_extended(self):
+        self.assertEqual(self.filter(LABEL + " /REF 123456"), [])
+
+    def test_other_payer(self):
+        self.assertEqual(self.filter(OTHER), [OTHER])
+
+    def test_boilerplate_only(self):
+        self.assertEqual(self.filter("VIR SEPA RECU"), ["VIR SEPA RECU"])
+
+    def test_best_pair(self):
+        # The other payer comes first but mustn't take the recorded payment
+        self.assertEqual(self.filter(OTHER, LABEL[:47]), [OTHER])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
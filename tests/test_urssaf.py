@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import persist
+import urssaf
+
+
+
+def context(certif, attendu, amount="1000"):
+    return {
+        "contexte": {"mode": "existante"},
+        "data": {
+            "declaration": {
+                "certif": certif,
+                "ass": {"ass_autres": amount},
+                "cts": [],
+                "mts": {"mtapa": "220"},
+            },
+            "paiement": {"attendu": attendu, "sepa": {}},
+        },
+    }
+
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.snapshot = os.path.join(self._tmpdir.name, "snapshot.json")
+
+        with mock.patch.object(urssaf.URSSAF, "_login"):
+            self.urss = urssaf.URSSAF("login", "pwd", snapshot=self.snapshot)
+        self.urss._main_config = {"declaration": {"baseURL": "https://urssaf.invalid/api/declaration"}}
+        self.urss._profile_ctx = {}
+        self.urss._access_token = "token"
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def server(self, ctx):
+        return mock.patch.object(self.urss, "post_xhr_json", return_value=ctx)
+
+    def test_paid_on_server(self):
+        # The SEPA payment went through but the snapshot wasn't dropped
+        persist.write_json(self.snapshot, {"state": "validated", "context": context("certified", "true")})
+
+        with self.server(context("certified", "false")) as post:
+            self.assertIsNone(self.urss.resume(1000))
+            with self.assertRaises(urssaf.AlreadyPaidError):
+                self.urss.declare(1000)
+
+        self.assertFalse(os.path.exists(self.snapshot))
+        urls = [c.args[0] for c in post.call_args_list]
+        self.assertFalse(any(u.endswith("/paiement/sepa") for u in urls))
+
+    def test_payment_expected(self):
+        persist.write_json(self.snapshot, {"state": "validated", "context": context("certified", "true")})
+
+        with self.server(context("certified", "true")):
+            self.assertEqual(self.urss.resume(1000), "validated")
+
+        self.assertEqual(self.urss.state, "validated")
+        self.assertTrue(os.path.exists(self.snapshot))
+
+    def test_validated_on_server(self):
+        persist.write_json(self.snapshot, {"state": "declared", "context": context("", "false")})
+
+        with self.server(context("certified", "false")):
+            self.assertIsNone(self.urss.resume(1000))
+
+        self.assertFalse(os.path.exists(self.snapshot))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,17 @@
 import base64
 from collections import Counter
+import contextlib
+import functools
 import hashlib
 import json
 import logging
+import os
 import random
 import re
-import requests
+import time
 import urllib.parse
 
-import jwcrypto.jws
-import jwcrypto.jwk
-import lxml.html
+import persist
 
 
 
@@ -28,6 +29,17 @@ def random_string(length):
 
 
 
+def traced(name):
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(self, *args, **kwargs):
+            with self.step(name):
+                return f(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+
 def matching_braces(s):
     assert s[0] == "{"
     cnt = 0
@@ -62,6 +74,72 @@ def enclosing_opening_brace(s, start):
 
 
 
+def parse_config_js(text):
+    j = text[text.find("{"):].replace(",\n}", "\n}")
+    config, _ = json.JSONDecoder().raw_decode(j)
+    return config
+
+
+
+def extract_main_config(mainjs, config, servicesurl):
+    oauthidx = mainjs.index("oauth:")
+    cfgidx = enclosing_opening_brace(mainjs, oauthidx)
+    oauthcfg = matching_braces(mainjs[cfgidx:])
+    oauthcfg = re.sub(r'(?<=[{,])(\w*):', '"\\1":', oauthcfg)
+
+    replace = {
+        "!0": "true",
+        "!1": "false",
+    }
+
+    cnt = Counter()
+    for k in config:
+        c = Counter(re.findall(r'\b(\w+)\.' + re.escape(k), oauthcfg))
+        cnt.update(c)
+    (config_varname, _) = cnt.most_common(1)[0]
+    replace.update({config_varname + "." + k: f'"{v}"' for k, v in config.items()})
+
+    # Get the shorthand variables as well
+    varsidx = mainjs.rindex(";", 0, cfgidx) + 1
+    shortvars = dict(re.findall(r'([\w$]+)\s*=\s*([\w.$]+),', mainjs[varsidx:cfgidx]))
+    del shortvars[config_varname]
+
+    # ... and the special base URL variable
+    baseurlvar, = re.findall(r'(\w+)\s*=\s*[^,]*\blocation\b[^,]*,', mainjs[varsidx:cfgidx])
+    shortvars[baseurlvar] = json.dumps(servicesurl)
+    replace.update({k: replace.get(v, v) for k, v in shortvars.items()})
+
+    search = r'|'.join(r'(?<!\w)' + re.escape(s) + r'(?!\w)' for s in replace.keys())
+    oauthcfg = re.sub(search, lambda m: replace[m.group(0)], oauthcfg)
+
+    # Evaluate the parseInt calls
+    parseInt = lambda m: str(int(*eval(m.group(1))))
+    oauthcfg = re.sub(r'parseInt\(([\d\s,"\']*)\)', parseInt, oauthcfg)
+
+    # Concat the strings
+    oauthcfg = oauthcfg.replace('"+"', '')
+
+    # Evaluate the ternary operators
+    string = r'"(?:[^\\"]|\\")*"' + r'|' + r"'(?:[^\\']|\\')*'"
+    nonstring = r'[^"\']'
+    elem = r'\w+|' + string
+    tokens = r'(?:%s)*?' % elem
+    prefix = r'(?:%s|%s)*?' % (nonstring, string)
+    r = r'(%s)(%s)\?(%s):(%s)' % (prefix, elem, tokens, elem)
+
+    while True:
+        m = re.match(r, oauthcfg)
+        if m is None:
+            break
+        before, cond, iftrue, iffalse = m.groups()
+        repl = before + (iftrue if eval(cond) else iffalse)
+        oauthcfg = oauthcfg[:m.start()] + repl + oauthcfg[m.end():]
+
+    maincfg, _ = json.JSONDecoder().raw_decode(oauthcfg)
+    return maincfg
+
+
+
 class URSSAF(object):
     baseurl = "https://www.autoentrepreneur.urssaf.fr/"
     servicesurl = baseurl + "services/"
@@ -69,7 +147,11 @@ class URSSAF(object):
 
 
 
-    def __init__(self, login, pwd):
+    def __init__(self, login, pwd, snapshot=None, trace=None):
+        # Heavy imports are deferred so that the early exits of the scripts stay fast
+        import requests
+        import requests.adapters
+
         self._session = requests.Session()
         self._session.headers["User-Agent"] = "Mozzarella Firefox/1337.42 because fuck you! That's why."
         retry_status = {
@@ -90,11 +172,102 @@ class URSSAF(object):
         self._mandates = None
         self._state = None
         self._context = None
+        self._snapshot = snapshot
+        self._resumed = False
+        self._trace = trace
+        self._step = None
 
         self._login(login, pwd)
 
+    def reset(self, snapshot=None):
+        # Forget everything about the previous declaration but keep the session
+        self._profile_ctx = None
+        self._mandates = None
+        self._state = None
+        self._context = None
+        self._snapshot = snapshot
+        self._resumed = False
+
+    def token_expiry(self):
+        if self._access_token is None:
+            return None
+
+        try:
+            payload = self._access_token.split(".")[1]
+            payload = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+            return json.loads(payload)["exp"]
+        except (IndexError, ValueError, KeyError):
+            return None
+
+    def logged_in(self, margin=60):
+        expiry = self.token_expiry()
+        return expiry is not None and expiry > time.time() + margin
+
+    @contextlib.contextmanager
+    def step(self, name):
+        # Only the outermost step is recorded in the trace
+        outer = self._step is None
+        if outer:
+            self._step = name
+        try:
+            yield
+        finally:
+            if outer:
+                self._step = None
+
+    def _trace_request(self, method, url, start, res=None, error=None, size=None):
+        total = time.monotonic() - start
+        if res is None:
+            self._trace.record(self._step, method, url, None, None, None, total, None, error)
+            return
+
+        retries = getattr(res.raw, "retries", None)
+        retries = len(retries.history) if retries is not None else 0
+        if size is None:
+            size = len(res.content)
+
+        self._trace.record(self._step, method, url, res.status_code, retries,
+                           res.elapsed.total_seconds(), total, size, error)
+
+    def _trace_stream(self, method, url, start, res):
+        # The body of a streamed response is read after request() returns,
+        # record it once iter_content is exhausted to get its duration and size
+        iter_content = res.iter_content
+
+        def traced_iter_content(*args, **kwargs):
+            size = 0
+            error = None
+            try:
+                for chunk in iter_content(*args, **kwargs):
+                    size += len(chunk)
+                    yield chunk
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                self._trace_request(method, url, start, res, error, size)
+
+        res.iter_content = traced_iter_content
+
     def request(self, method, url, *args, **kwargs):
-        res = self._session.request(method, url, *args, **kwargs)
+        import requests
+
+        if self._trace is None:
+            res = self._session.request(method, url, *args, **kwargs)
+            res.raise_for_status()
+            return res
+
+        start = time.monotonic()
+        try:
+            res = self._session.request(method, url, *args, **kwargs)
+        except requests.RequestException as e:
+            self._trace_request(method, url, start, error=type(e).__name__)
+            raise
+
+        if kwargs.get("stream") and res.ok:
+            self._trace_stream(method, url, start, res)
+        else:
+            self._trace_request(method, url, start, res)
         res.raise_for_status()
         return res
 
@@ -108,16 +281,14 @@ class URSSAF(object):
         return res
 
     def get(self, url, *args, **kwargs):
-        res = self._session.get(url, *args, **kwargs)
-        res.raise_for_status()
-        return res
+        return self.request("GET", url, *args, **kwargs)
 
     def post(self, url, *args, **kwargs):
-        res = self._session.post(url, *args, **kwargs)
-        res.raise_for_status()
-        return res
+        return self.request("POST", url, *args, **kwargs)
 
     def get_html(self, url, *args, **kwargs):
+        import lxml.html
+
         res = self.get(url, *args, **kwargs)
         doc = lxml.html.fromstring(res.content, base_url=res.url)
         doc.make_links_absolute()
@@ -137,8 +308,7 @@ class URSSAF(object):
             return self._config
 
         res = self.get(self.configurl)
-        j = res.text[res.text.find("{"):].replace(",\n}", "\n}")
-        self._config, _ = json.JSONDecoder().raw_decode(j)
+        self._config = parse_config_js(res.text)
         return self._config
 
 
@@ -165,60 +335,7 @@ class URSSAF(object):
 
         config = self._get_config()
         mainjs = self._get_mainjs()
-        oauthidx = mainjs.index("oauth:")
-        cfgidx = enclosing_opening_brace(mainjs, oauthidx)
-        oauthcfg = matching_braces(mainjs[cfgidx:])
-        oauthcfg = re.sub(r'(?<=[{,])(\w*):', '"\\1":', oauthcfg)
-
-        replace = {
-            "!0": "true",
-            "!1": "false",
-        }
-
-        cnt = Counter()
-        for k in config:
-            c = Counter(re.findall(r'\b(\w+)\.' + re.escape(k), oauthcfg))
-            cnt.update(c)
-        (config_varname, _) = cnt.most_common(1)[0]
-        replace.update({config_varname + "." + k: f'"{v}"' for k, v in config.items()})
-
-        # Get the shorthand variables as well
-        varsidx = mainjs.rindex(";", 0, cfgidx) + 1
-        shortvars = dict(re.findall(r'([\w$]+)\s*=\s*([\w.$]+),', mainjs[varsidx:cfgidx]))
-        del shortvars[config_varname]
-
-        # ... and the special base URL variable
-        baseurlvar, = re.findall(r'(\w+)\s*=\s*[^,]*\blocation\b[^,]*,', mainjs[varsidx:cfgidx])
-        shortvars[baseurlvar] = json.dumps(self.servicesurl)
-        replace.update({k: replace.get(v, v) for k, v in shortvars.items()})
-
-        search = r'|'.join(r'(?<!\w)' + re.escape(s) + r'(?!\w)' for s in replace.keys())
-        oauthcfg = re.sub(search, lambda m: replace[m.group(0)], oauthcfg)
-
-        # Evaluate the parseInt calls
-        parseInt = lambda m: str(int(*eval(m.group(1))))
-        oauthcfg = re.sub(r'parseInt\(([\d\s,"\']*)\)', parseInt, oauthcfg)
-
-        # Concat the strings
-        oauthcfg = oauthcfg.replace('"+"', '')
-
-        # Evaluate the ternary operators
-        string = r'"(?:[^\\"]|\\")*"' + r'|' + r"'(?:[^\\']|\\')*'"
-        nonstring = r'[^"\']'
-        elem = r'\w+|' + string
-        tokens = r'(?:%s)*?' % elem
-        prefix = r'(?:%s|%s)*?' % (nonstring, string)
-        r = r'(%s)(%s)\?(%s):(%s)' % (prefix, elem, tokens, elem)
-
-        while True:
-            m = re.match(r, oauthcfg)
-            if m is None:
-                break
-            before, cond, iftrue, iffalse = m.groups()
-            repl = before + (iftrue if eval(cond) else iffalse)
-            oauthcfg = oauthcfg[:m.start()] + repl + oauthcfg[m.end():]
-
-        self._main_config, _ = json.JSONDecoder().raw_decode(oauthcfg)
+        self._main_config = extract_main_config(mainjs, config, self.servicesurl)
         return self._main_config
 
 
@@ -254,6 +371,9 @@ class URSSAF(object):
 
 
     def _verify_token(self, access_token):
+        import jwcrypto.jwk
+        import jwcrypto.jws
+
         config = self._get_config()
         jwksurl = config["ARCHIMED_LOGIN_API_URL"] + "jwks"
         jwks = self.get(jwksurl).content
@@ -267,6 +387,7 @@ class URSSAF(object):
 
 
 
+    @traced("login")
     def _login(self, login, pwd):
         maincfg = self._get_main_config()
         oauthcfg = maincfg["oauth"]
@@ -325,6 +446,7 @@ class URSSAF(object):
 
 
 
+    @traced("mandates")
     def get_mandates(self):
         if self._mandates is not None:
             return self._mandates
@@ -355,6 +477,7 @@ class URSSAF(object):
 
 
 
+    @traced("context")
     def get_context(self):
         if self._context is not None:
             return self._context
@@ -365,7 +488,7 @@ class URSSAF(object):
         ctx = self.post_xhr_json(url, json=self._get_profile_context())
 
         mode = ctx["contexte"]["mode"]
-        # TODO: allow resuming a previously aborted declaration
+        # Previously aborted declarations are resumed from the snapshot, see resume()
         if mode not in ("nouvelle", "existante"):
             logging.warning("Unknown context mode %r, won't declare anything with this", mode)
             self._state = "mode_error"
@@ -376,14 +499,104 @@ class URSSAF(object):
 
 
     def post_declaration_context(self, urlfrag, *args, **kwargs):
+        import requests
+
         cfg = self._get_main_config()
         url = cfg["declaration"]["baseURL"] + urlfrag
-        res = self.post_xhr_json(url, *args, json=self._context, **kwargs)
+        try:
+            res = self.post_xhr_json(url, *args, json=self._context, **kwargs)
+        except requests.HTTPError:
+            if self._resumed:
+                logging.warning("Resumed declaration rejected, it will be restarted from scratch next time")
+                self._drop_snapshot()
+            raise
+
         self._context = res
         return res
 
 
 
+    @property
+    def state(self):
+        return self._state
+
+
+
+    def _save_snapshot(self):
+        if self._snapshot is None:
+            return
+
+        logging.debug("Saving declaration context in state %s to %r", self._state, self._snapshot)
+        persist.write_json(self._snapshot, {"state": self._state, "context": self._context})
+
+
+
+    def _drop_snapshot(self):
+        if self._snapshot is not None and os.path.exists(self._snapshot):
+            logging.debug("Removing declaration snapshot %r", self._snapshot)
+            os.unlink(self._snapshot)
+
+
+
+    def resume(self, amount):
+        if self._snapshot is None:
+            return None
+
+        snap = persist.read_json(self._snapshot)
+        if snap is None:
+            return None
+
+        state = snap["state"]
+        ctx = snap["context"]
+        if state not in ("declared", "validated"):
+            logging.warning("Can't resume a declaration from state %r", state)
+            return None
+
+        amount = str(round(amount))
+        declared = ctx["data"]["declaration"]["ass"]["ass_autres"]
+        if declared != amount:
+            logging.warning("Aborted declaration was for %s instead of %s. Not resuming it.", declared, amount)
+            return None
+
+        # The step after the snapshot may have gone through on the server even
+        # though it wasn't saved, replaying it could pay twice
+        server = self.get_context()
+        if self._state is not None:
+            return None
+
+        if state == "declared":
+            pending = (len(server["data"]["declaration"]["certif"]) <= 2)
+        else:
+            pending = (server["data"]["paiement"]["attendu"] == "true")
+
+        if not pending:
+            logging.warning("Aborted declaration in state %s was completed on the server, not resuming it", state)
+            self._drop_snapshot()
+            return None
+
+        logging.info("Resuming declaration of %s euros from state %s", declared, state)
+        self._context = ctx
+        self._state = state
+        self._resumed = True
+        return state
+
+
+
+    def taxes(self):
+        ret = []
+        for tax in self._context["data"]["declaration"]["cts"]:
+            t = {
+                "desc": tax["lib"],
+                "amount": float(tax["mt"]),
+                "rate": float(tax["taux"][:-1])
+            }
+            ret.append(t)
+
+        return ret, float(self._context["data"]["declaration"]["mts"]["mtapa"])
+
+
+
+    @traced("declare")
     def declare(self, amount, redo="never"):
         if redo not in ("never", "ifchanged", "always"):
             raise ValueError(f"Unknown argument value for redo={redo!r}")
@@ -423,22 +636,15 @@ class URSSAF(object):
         # submit form
         logging.info("Declaring %s euros", amount)
         self.post_declaration_context("/declaration/calculer")
+        self._state = "declared"
+        self._save_snapshot()
 
         # Extract interesting informations
-        ret = []
-        for tax in self._context["data"]["declaration"]["cts"]:
-            t = {
-                "desc": tax["lib"],
-                "amount": float(tax["mt"]),
-                "rate": float(tax["taux"][:-1])
-            }
-            ret.append(t)
-
-        self._state = "declared"
-        return ret, float(self._context["data"]["declaration"]["mts"]["mtapa"])
+        return self.taxes()
 
 
 
+    @traced("validate")
     def validate_declaration(self):
         if self._state != "declared":
             raise RuntimeError("Must delcare an income before validating it")
@@ -449,9 +655,11 @@ class URSSAF(object):
         self._context["data"]["declaration"]["certif"] = None
         self.post_declaration_context("/declaration/valider")
         self._state = "validated"
+        self._save_snapshot()
 
 
 
+    @traced("pay")
     def pay(self, mandate=None):
         # TODO: Maybe allow to customize the amount paid from each mandate?
 
@@ -483,6 +691,7 @@ class URSSAF(object):
         logging.info("Paying %s euros with IBAN %s", amount, mandate["IBAN"])
         self.post_declaration_context("/paiement/sepa")
         self._state = None
+        self._drop_snapshot()
 
         # return the relevant information (link to pdf)
         return self._context, self._context["data"]["declaration_pdf"]